@@ -0,0 +1,93 @@
+import io
+import os
+import posixpath
+import tarfile
+import zipfile
+
+# separates the archive path and the member name, e.g. "experiment.zip::cell1/image.tif"
+archive_sep = "::"
+archive_exts = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+def is_archive(path):
+    return path.lower().endswith(archive_exts)
+
+
+def split_member_path(path):
+    """
+    :return: archive path and member name, member name is None if path is not an archive member
+    """
+    if archive_sep in path:
+        archive_path, member = path.split(archive_sep, 1)
+        return archive_path, member
+    return path, None
+
+
+def is_member_path(path):
+    return split_member_path(path)[1] is not None
+
+
+def source_name(path):
+    """
+    File name of a file or an archive member, e.g. "a-giantin.tif" for "exp.zip::cell1/a-giantin.tif".
+    """
+    member = split_member_path(path)[1]
+    if member is None:
+        return os.path.basename(path)
+    # member names are separated by "/" in zip and tar archives
+    return posixpath.basename(member)
+
+
+def list_archive_tifs(archive_path):
+    """
+    :return: member paths of the .tif files in an archive, in archive order
+    """
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            members = [info.filename for info in zf.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(archive_path) as tf:
+            members = [info.name for info in tf.getmembers() if info.isfile()]
+    return [archive_sep.join((archive_path, member)) for member in members if member.endswith(".tif")]
+
+
+def read_member(path):
+    """
+    Read an archive member into memory, without extracting it to disk.
+    """
+    archive_path, member = split_member_path(path)
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            return zf.read(member)
+    # a compressed tar is read sequentially up to the member
+    with tarfile.open(archive_path) as tf:
+        f = tf.extractfile(member)
+        if f is None:
+            raise Exception("{} is not a file in {}".format(member, archive_path))
+        return f.read()
+
+
+def open_source(path):
+    """
+    :return: path, or BytesIO of an archive member, for tifffile
+    """
+    if is_member_path(path):
+        return io.BytesIO(read_member(path))
+    return path
+
+
+def stat_source(path):
+    """
+    Identity of a file or an archive member: real path, size and mtime. A member takes the size and mtime of its
+    archive, so it is invalidated when the archive changes.
+    """
+    archive_path, member = split_member_path(path)
+    real_path = os.path.realpath(archive_path)
+    stat = os.stat(real_path)
+    if member is not None:
+        real_path = archive_sep.join((real_path, member))
+    return real_path, stat.st_size, stat.st_mtime_ns
+
+
+def source_exists(path):
+    return os.path.exists(split_member_path(path)[0])
@@ -8,24 +8,27 @@ from matplotlib import pyplot as plt
 from patchify import patchify
 import math
 
+from moments import center_of_mass, gyradius
+
+
+def get_pad_width(size, target_size):
+    """
+    Padding before and after one axis. The odd pixel goes before.
+    """
+    diff = target_size - size
+    return diff - diff // 2, diff // 2
+
 
 def get_img_pad(img, patch_size=256, patchify_step=206):
+    """
+    Pad each side to the smallest size covered by a patch grid, so a rectangular image gets a rectangular grid.
+    :return: (target_h, target_w), padded image
+    """
     h, w = img.shape
-    max_side = max(h, w)
-    target_size = math.ceil((max_side - patch_size) / patchify_step) * patchify_step + patch_size
-    diff_h = target_size - h
-    diff_w = target_size - w
-    if diff_h % 2 != 0:
-        h_pad = (round(diff_h / 2) + 1, round(diff_h / 2) - 1)
-    else:
-        h_pad = round(diff_h / 2)
-    if diff_w % 2 != 0:
-        w_pad = (round(diff_w / 2) + 1, round(diff_w / 2) - 1)
-    else:
-        w_pad = round(diff_w / 2)
-    # print(h_pad, w_pad)
-    img_pad = np.pad(img, (h_pad, w_pad), "constant", constant_values=0)
-    return target_size, img_pad
+    target_h = max(math.ceil((h - patch_size) / patchify_step), 0) * patchify_step + patch_size
+    target_w = max(math.ceil((w - patch_size) / patchify_step), 0) * patchify_step + patch_size
+    img_pad = np.pad(img, (get_pad_width(h, target_h), get_pad_width(w, target_w)), "constant", constant_values=0)
+    return (target_h, target_w), img_pad
 
 
 def get_img_unpad(img, pad_size):
@@ -38,11 +41,18 @@ def get_img_unpad(img, pad_size):
     return unpad
 
 
+def get_patch_grid(pad_shape, patch_size=(256, 256), patch_step=206):
+    """
+    No. of patch rows and columns of a padded image.
+    """
+    return (pad_shape[0] - patch_size[0]) // patch_step + 1, (pad_shape[1] - patch_size[1]) // patch_step + 1
+
+
 def padding_image(image_list, do_patchify=True, clear_edge_roi=True, patch_size=(256, 256), patch_step=206):
     pad_image_list = []
     patches_list = []
     for image in image_list:
-        target_size, pad_image = get_img_pad(image)
+        target_size, pad_image = get_img_pad(image, patch_size=patch_size[0], patchify_step=patch_step)
         # print(target_size)
         pad_image_list.append(pad_image)
         if do_patchify:
@@ -57,10 +67,10 @@ def padding_image(image_list, do_patchify=True, clear_edge_roi=True, patch_size=
 def unpadding_image(padding_image_list, original_image_list):
     unpad_img_list = []
     for i, pad_img in enumerate(padding_image_list):
-        original_shape = original_image_list[i].shape
-        pad_img_shape = pad_img.shape
-        pad_size = int((pad_img_shape[0] - original_shape[0]) / 2)
-        unpad_img = get_img_unpad(pad_img, pad_size)
+        h, w = original_image_list[i].shape[:2]
+        top, _ = get_pad_width(h, pad_img.shape[0])
+        left, _ = get_pad_width(w, pad_img.shape[1])
+        unpad_img = pad_img[top:top + h, left:left + w]
         unpad_img_list.append(unpad_img)
     return unpad_img_list
 
@@ -76,15 +86,81 @@ def clear_mask_patches(patches_in):
                 continue
             contours, _ = cv2.findContours(cleared_patches[i][j], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
             for n, contour in enumerate(contours):
-                c_x = contour[:, :, 0].reshape(-1, )
-                c_y = contour[:, :, 1].reshape(-1, )
-                if h - 1 in c_x or w - 1 in c_y or 0 in c_x or 0 in c_y:
+                if on_crop_edge(contour, h, w):
                     # clear the edge contours
                     cv2.drawContours(cleared_patches[i][j], contours, n, 0, -1)
                     continue
     return cleared_patches
 
 
+def otsu_threshold(image, bins=256):
+    """
+    Otsu threshold of an image of any dtype, computed on its histogram.
+    """
+    hist, bin_edges = np.histogram(image, bins=bins)
+    hist = hist.astype(np.float64)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * bin_centers)
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+    between_var = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return bin_edges[np.argmax(between_var) + 1]
+
+
+def screen_background_patches(image, patches, min_foreground_pixels=1):
+    """
+    Find the patches which are worth predicting. A patch is background if it has less than min_foreground_pixels
+    pixels brighter than the Otsu threshold of the whole giantin image.
+    :param image: giantin image, shape (h,w)
+    :param patches: patches of the padded image, shape (n,256,256)
+    :param min_foreground_pixels:
+    :return: boolean array of patches to keep, shape (n,)
+    """
+    if image.max() == image.min():
+        return np.zeros(len(patches), dtype=np.bool_)
+    threshold = otsu_threshold(image)
+    num_foreground = (patches > threshold).reshape((len(patches), -1)).sum(axis=1)
+    return num_foreground >= min_foreground_pixels
+
+
+def locate_candidates(model, image, downsample=4, threshold=0.3, margin=64, batch_size=32):
+    """
+    Coarse localisation of giantin: predict a downsampled image, threshold it and dilate by margin.
+    :param model: model with predict_on_batch
+    :param image: giantin image, shape (h,w)
+    :param downsample: downsample factor
+    :param threshold: probability threshold of a candidate, lower than param_pixel_threshold
+    :param margin: dilation of candidates, in full resolution pixels
+    :param batch_size:
+    :return: candidate mask in full resolution, shape (h,w), uint8
+    """
+    h, w = image.shape
+    small_image = cv2.resize(image, (max(w // downsample, 1), max(h // downsample, 1)), interpolation=cv2.INTER_AREA)
+    padded_list, patches_list = padding_image([small_image], do_patchify=True, clear_edge_roi=False)
+    model_input = make_model_input(patches_list, do_norm=True, data_shape=(-1, 256, 256, 1))
+    model_pred = [pred for _, pred in batch_predict(model, model_input, batch_size=batch_size)]
+    pred_mask, _ = pred_to_mask(model_pred, grid_shape_list=[get_patch_grid(padded_list[0].shape)])
+    small_pred = unpadding_image(pred_mask, [small_image])[0]
+    candidate_mask = np.array(small_pred > threshold, dtype=np.uint8)
+    kernel_size = 2 * math.ceil(margin / downsample) + 1
+    candidate_mask = cv2.dilate(candidate_mask, np.ones((kernel_size, kernel_size), dtype=np.uint8))
+    return cv2.resize(candidate_mask, (w, h), interpolation=cv2.INTER_NEAREST)
+
+
+def candidate_patches(candidate_mask, patch_size=(256, 256), patch_step=206):
+    """
+    Patches of the padded image which overlap a candidate region.
+    :param candidate_mask: shape (h,w), the same shape as the image
+    :return: boolean array of patches to keep, shape (n,)
+    """
+    _, mask_patches_list = padding_image([candidate_mask], do_patchify=True, clear_edge_roi=False,
+                                         patch_size=patch_size, patch_step=patch_step)
+    mask_patches = mask_patches_list[0]
+    return mask_patches.reshape((len(mask_patches), -1)).any(axis=1)
+
+
 def make_model_input(image_list, do_norm=True, data_shape=(-1, 256, 256, 1)):
     out_list = []
     for image in image_list:
@@ -106,6 +182,111 @@ def make_model_input(image_list, do_norm=True, data_shape=(-1, 256, 256, 1)):
     # return out, number_patches_perimage
 
 
+def batch_predict(model, model_input_list, batch_size=32):
+    """
+    Predict the patches of all images in fixed-size batches. Patches are concatenated across images,
+    so the number of predict calls does not depend on how the dataset is split into files.
+    :param model: keras model
+    :param model_input_list: iterable of model input, each shape is (n, 256, 256, 1)
+    :param batch_size: number of patches per batch. The last batch is zero-filled to keep the same shape.
+    :return: generator of (image index, prediction), in input order. Prediction shape is (n, 256, 256, 1)
+    """
+    batch = None
+    batch_fill = 0
+    # [image index, no. of patches, predicted parts]
+    pending = []
+
+    def pop_finished():
+        finished = []
+        while len(pending) > 0 and sum(len(part) for part in pending[0][2]) == pending[0][1]:
+            index, _, parts = pending.pop(0)
+            finished.append((index, np.concatenate(parts, axis=0)))
+        return finished
+
+    def flush():
+        pred = model.predict_on_batch(batch)
+        pred = np.asarray(pred)[:batch_fill]
+        offset = 0
+        for item in pending:
+            num_done = sum(len(part) for part in item[2])
+            num_take = min(item[1] - num_done, batch_fill - offset)
+            if num_take > 0:
+                item[2].append(pred[offset:offset + num_take])
+                offset += num_take
+        return pop_finished()
+
+    for index, model_input in enumerate(model_input_list):
+        if batch is None:
+            batch = np.zeros((batch_size,) + model_input.shape[1:], dtype=np.float32)
+        pending.append([index, len(model_input), [np.zeros((0,) + model_input.shape[1:], dtype=np.float32)]])
+        start = 0
+        while start < len(model_input):
+            num_copy = min(batch_size - batch_fill, len(model_input) - start)
+            batch[batch_fill:batch_fill + num_copy] = model_input[start:start + num_copy]
+            batch_fill += num_copy
+            start += num_copy
+            if batch_fill == batch_size:
+                yield from flush()
+                batch_fill = 0
+        # images without any patch (cached, mosaic, all background) are done as soon as the images before them are,
+        # not at the next full batch
+        yield from pop_finished()
+    if batch_fill > 0:
+        batch[batch_fill:] = 0
+        yield from flush()
+
+
+def normalize_columns(image, band_size=256):
+    """
+    L2 normalize each column in bands of band_size rows. It is what make_model_input does to a 256x256 patch,
+    applied to a whole image. The bands start at row 0 of the image, not at the patch grid (step 206), so the input
+    scale differs from patch inference and jumps at band boundaries. Check the effect with inference.py --parity
+    --whole.
+    :param image: shape (h,w)
+    :param band_size: no. of rows of one band
+    :return: float image
+    """
+    out = np.zeros(image.shape, dtype=np.float32)
+    for start in range(0, image.shape[0], band_size):
+        band = image[start:start + band_size].astype(np.float64)
+        l2 = np.linalg.norm(band, 2, axis=0)
+        l2[l2 == 0] = 1
+        out[start:start + band_size] = band / l2
+    return out
+
+
+def predict_whole_image(model, image, tile_size=1024, halo=32, multiple=16):
+    """
+    Fully convolutional prediction of a whole image, without overlapping 256x256 patches.
+    The image is predicted in one forward pass if it fits in one tile, otherwise in large tiles with a halo.
+    :param model: keras model with input shape (None, None, None, 1)
+    :param image: giantin image, shape (h,w)
+    :param tile_size: max side of one tile, multiple of `multiple`
+    :param halo: context pixels around each tile, dropped from the output
+    :param multiple: input side must be multiple of it, 2^(no. of poolings)
+    :return: probability map, shape (h,w)
+    """
+    h, w = image.shape
+    norm_image = normalize_columns(image)
+    pred = np.zeros((h, w), dtype=np.float32)
+    if h <= tile_size and w <= tile_size:
+        halo = 0
+    for y0 in range(0, h, tile_size):
+        for x0 in range(0, w, tile_size):
+            y1 = min(y0 + tile_size, h)
+            x1 = min(x0 + tile_size, w)
+            # tile with halo, clipped by the image
+            ty0, tx0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            ty1, tx1 = min(y1 + halo, h), min(x1 + halo, w)
+            tile = norm_image[ty0:ty1, tx0:tx1]
+            pad_h = math.ceil(tile.shape[0] / multiple) * multiple - tile.shape[0]
+            pad_w = math.ceil(tile.shape[1] / multiple) * multiple - tile.shape[1]
+            tile = np.pad(tile, ((0, pad_h), (0, pad_w)), "constant", constant_values=0)
+            tile_pred = np.asarray(model(tile[np.newaxis, :, :, np.newaxis], training=False))[0, :, :, 0]
+            pred[y0:y1, x0:x1] = tile_pred[y0 - ty0:y1 - ty0, x0 - tx0:x1 - tx0]
+    return pred
+
+
 def clear_blank_mask(images, masks, ratio_of_blank=0.1):
     new_masks_tmp = []
     new_images_tmp = []
@@ -129,7 +310,7 @@ def clear_blank_mask(images, masks, ratio_of_blank=0.1):
 def unpatchify(patches, imsize, patch_step=206):
     """
     unpatchify the patches, the overlapped pixels are considered as the max value.
-    :param patches: shape(n,n,h,h)
+    :param patches: shape(nrow,ncol,h,w)
     :param imsize:
     :param patch_step:
     :return:
@@ -160,44 +341,97 @@ def unpatchify(patches, imsize, patch_step=206):
     return ret_image
 
 
-def pred_to_mask(preds, patch_size=(256, 256), patch_step=206):
+def pred_to_mask(preds, grid_shape_list=None, keep_list=None, patch_size=(256, 256), patch_step=206):
+    """
+    Convert model output to padded masks.
+    :param preds: model output of each image, shape (n, 256, 256, 1)
+    :param grid_shape_list: (no. of patch rows, no. of patch columns) of each image, see get_patch_grid.
+            None for square grids.
+    :param keep_list: boolean array of predicted patches of each image, see screen_background_patches.
+            preds only have the kept patches, the others are zero. None if all patches are predicted.
+    :param patch_size:
+    :param patch_step:
+    :return: padded masks, mask patches
+    """
     ret_mask_list = []
     ret_mask_patches_list = []
-    for mask_patches in preds:
-        num_rows_patches = int(np.sqrt(mask_patches.shape[0]))
-        mask_patches_np = np.array(mask_patches).reshape((num_rows_patches, num_rows_patches, patch_size[0],
+    for i, mask_patches in enumerate(preds):
+        if keep_list is not None:
+            all_patches = np.zeros((len(keep_list[i]),) + mask_patches.shape[1:], dtype=np.float32)
+            all_patches[keep_list[i]] = mask_patches
+            mask_patches = all_patches
+        if grid_shape_list is None:
+            num_rows_patches = int(np.sqrt(mask_patches.shape[0]))
+            num_cols_patches = num_rows_patches
+        else:
+            num_rows_patches, num_cols_patches = grid_shape_list[i]
+        mask_patches_np = np.array(mask_patches).reshape((num_rows_patches, num_cols_patches, patch_size[0],
                                                           patch_size[1]))
-        imsize = patch_size[0] + (num_rows_patches - 1) * patch_step
-        padded_mask = unpatchify(mask_patches_np, imsize=(imsize, imsize), patch_step=patch_step)
+        imsize = (patch_size[0] + (num_rows_patches - 1) * patch_step,
+                  patch_size[1] + (num_cols_patches - 1) * patch_step)
+        padded_mask = unpatchify(mask_patches_np, imsize=imsize, patch_step=patch_step)
         ret_mask_list.append(padded_mask)
         ret_mask_patches_list.append(mask_patches)
     return ret_mask_list, ret_mask_patches_list
 
 
-def check_contours(golgi_image, pred_mask, contour, min_giantin_area, giantin_possibility_threshold,
-                   giantin_channel, blank_channel=-1, rect_size=40, sub_list=None, show_plt=False, overlapping=True):
+def find_candidates(thres_mask, min_area=0, clear_edge=False):
     """
-    Check pred_masks' contours
-    :param sub_list: Last time bgst value in each channel. None then first sub.
-    :param golgi_image: [h,w,c]
-    :param pred_mask:
-    :param contour:
-    :param giantin_channel:
-    :param blank_channel:
-    :param min_giantin_area: minimum area of contour
-    :param giantin_possibility_threshold: threshold of mean possibility of one giantin
-    :param rect_size:
-    :param show_plt:
-    :param overlapping: giantin channel have overlapping with other channel
-    :return:
+    External contours of thres_mask, the same as cv2.findContours with RETR_EXTERNAL, in the same order (the last found
+    first), less the ones which fail the area and edge tests of screen_contour. Bounding box and nesting of all
+    components come from one connectedComponentsWithStats pass, and contours are only traced for the components whose
+    bounding box is large enough.
+    :param min_area: contours with a smaller cv2.contourArea are dropped. The contour runs through the centers of the
+    boundary pixels, so its area is never larger than the bounding box, but may be larger than the no. of pixels.
+    :param clear_edge: drop the components whose bounding box is in the edge, the same test as check_contours
+    :return: list of contours, no. of contours dropped by area, no. of contours dropped by edge
+    """
+    img_h, img_w = thres_mask.shape
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(thres_mask, connectivity=8)
+    # components in the holes of other components have no external contour. The background outside all of them is
+    # the 4-connected background touching the border of the padded mask.
+    background = np.pad(thres_mask == 0, 1, constant_values=True).astype(np.uint8)
+    _, background_labels = cv2.connectedComponents(background, connectivity=4)
+    outside = (background_labels == background_labels[0, 0]).astype(np.uint8)
+    outside = cv2.dilate(outside, cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3)))[1:-1, 1:-1]
+    external = np.zeros(num_labels, dtype=np.bool_)
+    external[np.unique(labels[(outside > 0) & (labels > 0)])] = True
+    # label 0 is background
+    external[0] = False
+    xs, ys, ws, hs, _ = stats.T.astype(np.int64)
+    keep = external & (ws * hs >= min_area)
+    num_small = int(np.count_nonzero(external & ~keep))
+    num_edge = 0
+    in_edge = (xs == 0) | (ys == 0) | (xs + ws == img_w - 1) | (ys + hs == img_h - 1)
+    candidates = []
+    for label in np.flatnonzero(keep):
+        x, y, w, h = xs[label], ys[label], ws[label], hs[label]
+        component = np.pad((labels[y:y + h, x:x + w] == label).astype(np.uint8), 1)
+        contours, _ = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE,
+                                       offset=(int(x) - 1, int(y) - 1))
+        # same order of tests as screen_contour, so the rejections are counted the same
+        if cv2.contourArea(contours[0]) < min_area:
+            num_small += 1
+            continue
+        if clear_edge and in_edge[label]:
+            num_edge += 1
+            continue
+        # findContours starts a contour at the first pixel in raster order
+        start = (y, x + int(np.argmax(component[1, 1:-1])))
+        candidates.append((start, contours[0]))
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    return [contour for _, contour in candidates], num_small, num_edge
+
+
+def get_crop_window(contour_rect, golgi_w, golgi_h, rect_size=40):
+    """
+    Square crop window around a contour.
+    :param contour_rect: x, y, w, h of the contour
+    :return: roi_coord [x, y, w, h], edge_contour: if the window is close to the edge of img [left, top, right, bottom]
     """
     # left top right bottom
     edge_contour = [0, 0, 0, 0]
-    golgi_h, golgi_w, golgi_c = golgi_image.shape
-    x, y, w, h = cv2.boundingRect(contour)
-    if x == 0 or y == 0 or x + w == golgi_w - 1 or y + h == golgi_h - 1:
-        reject_msg = "Giantin is in the edge."
-        return None, None, None, None, False, sub_list, reject_msg, None
+    x, y, w, h = contour_rect
     max_size = max(w, h)
     if max_size >= rect_size:
         rect_size = (max_size // 10 + 1) * 10
@@ -222,7 +456,43 @@ def check_contours(golgi_image, pred_mask, contour, min_giantin_area, giantin_po
     if y1 == golgi_h - 1:
         edge_contour[3] = 1
     # x,y,w,h
-    roi_coord = [x0, y0, x1 - x0, y1 - y0]
+    return [x0, y0, x1 - x0, y1 - y0], edge_contour
+
+
+def window_contains(roi_coord, contour_rect):
+    x0, y0, rect_w, rect_h = roi_coord
+    x, y, w, h = contour_rect
+    return x0 <= x and y0 <= y and x + w <= x0 + rect_w and y + h <= y0 + rect_h
+
+
+def check_contours(golgi_image, pred_mask, contour, min_giantin_area, giantin_possibility_threshold,
+                   giantin_channel, blank_channel=-1, rect_size=40, sub_list=None, show_plt=False, overlapping=True,
+                   level_search="step"):
+    """
+    Check pred_masks' contours
+    :param sub_list: Last time bgst value in each channel. None then first sub.
+    :param golgi_image: [h,w,c]
+    :param pred_mask:
+    :param contour:
+    :param giantin_channel:
+    :param blank_channel:
+    :param min_giantin_area: minimum area of contour
+    :param giantin_possibility_threshold: threshold of mean possibility of one giantin
+    :param rect_size:
+    :param show_plt:
+    :param overlapping: giantin channel have overlapping with other channel
+    :param level_search: "step" or "bisect", search of the bgst level in check_golgi_crop
+    :return:
+    """
+    golgi_h, golgi_w, golgi_c = golgi_image.shape
+    x, y, w, h = cv2.boundingRect(contour)
+    if x == 0 or y == 0 or x + w == golgi_w - 1 or y + h == golgi_h - 1:
+        reject_msg = "Giantin is in the edge."
+        return None, None, None, None, False, sub_list, reject_msg, None
+    roi_coord, edge_contour = get_crop_window((x, y, w, h), golgi_w, golgi_h, rect_size=rect_size)
+    x0, y0, rect_w, rect_h = roi_coord
+    x1 = x0 + rect_w
+    y1 = y0 + rect_h
     crop_golgi = np.copy(golgi_image[y0:y1, x0:x1, :])
     crop_mask = np.copy(pred_mask[y0:y1, x0:x1])
     if show_plt:
@@ -249,7 +519,8 @@ def check_contours(golgi_image, pred_mask, contour, min_giantin_area, giantin_po
                                                                                               min_giantin_area=min_giantin_area,
                                                                                               giantin_possibility_threshold=
                                                                                               giantin_possibility_threshold,
-                                                                                              have_overlapping=overlapping)
+                                                                                              have_overlapping=overlapping,
+                                                                                              level_search=level_search)
 
     # if flag:
     #     circularity = 4 * np.pi * cv2.contourArea(giantin_contour) / (
@@ -317,8 +588,111 @@ def check_contours(golgi_image, pred_mask, contour, min_giantin_area, giantin_po
     return clear_golgi, giantin_contour, crop_mask, giantin_mask, flag, sub_list, reject_msg, roi_coord
 
 
+# lookup tables of intensity_mask, keyed by dtype
+_intensity_mask_lut = {}
+
+
+def intensity_mask(task_img):
+    """
+    task_img / (task_img + 1) * 255 as uint8, the input of Otsu thresholding.
+    8 and 16-bit images use a lookup table built with the same arithmetic, so the result is identical.
+    """
+    if task_img.dtype in (np.uint8, np.uint16):
+        if task_img.dtype not in _intensity_mask_lut:
+            values = np.arange(np.iinfo(task_img.dtype).max + 1, dtype=task_img.dtype)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                _intensity_mask_lut[task_img.dtype] = (values / (values + np.array(1, dtype=values.dtype)) *
+                                                       255).astype(np.uint8)
+        return _intensity_mask_lut[task_img.dtype][task_img]
+    channel_mask = task_img / (task_img + 1) * 255
+    return channel_mask.astype(np.uint8)
+
+
+def subtract_background(task_img, sub):
+    """
+    Background subtraction in place: pixels brighter than sub are decreased by sub, the others are set to 0.
+    """
+    above = task_img > sub
+    if np.issubdtype(task_img.dtype, np.integer) and float(sub).is_integer():
+        np.subtract(task_img, task_img.dtype.type(sub), out=task_img, where=above)
+    else:
+        # the same float arithmetic and cast as per-pixel assignment
+        task_img[above] = task_img[above] - sub
+    task_img[~above] = 0
+
+
+def crop_contours(task_img, mode=cv2.RETR_EXTERNAL):
+    """
+    Contours of the Otsu mask of a bgst crop channel.
+    """
+    channel_mask = intensity_mask(task_img)
+    _, channel_mask = cv2.threshold(channel_mask, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(channel_mask, mode, cv2.CHAIN_APPROX_NONE)
+    return contours
+
+
+def contour_edges(contour, h, w):
+    """
+    If the contour has a point with x == 0, y == 0, x == h - 1 or y == w - 1 in the crop.
+    The points of a CHAIN_APPROX_NONE contour cover every column and row of its bounding rect, so the bounding rect
+    gives the same answer as scanning the points.
+    :return: [left, top, right, bottom]
+    """
+    x, y, rect_w, rect_h = cv2.boundingRect(contour)
+    return [x == 0, y == 0, x <= h - 1 < x + rect_w, y <= w - 1 < y + rect_h]
+
+
+def on_crop_edge(contour, h, w):
+    return any(contour_edges(contour, h, w))
+
+
+def subtraction_levels(task_img, min_sub=50):
+    """
+    Background levels, relative to task_img, that repeated bgst with sub = max(min nonzero, min_sub) steps through.
+    Built from the sorted intensities of task_img once.
+    :return: ascending list of levels, the last one clears the whole image
+    """
+    values = np.unique(task_img[task_img > 0])
+    levels = []
+    if values.size == 0:
+        return levels
+    max_value = values[-1].item()
+    level = 0
+    while level < max_value:
+        idx = np.searchsorted(values, level, side="right")
+        level = min(max(values[idx].item(), level + min_sub), max_value)
+        levels.append(level)
+    return levels
+
+
+def search_subtraction_level(task_img, still_sub, min_sub=50):
+    """
+    Bisect the candidate levels for the first one at which no further bgst is needed, instead of stepping through
+    them with one Otsu thresholding each. Assumes that once still_sub is False it stays False at higher levels.
+    :param task_img: crop channel
+    :param still_sub: function of the bgst crop channel, True if the background has to be subtracted further
+    :param min_sub: minimum step of bgst
+    :return: sub to apply to task_img
+    """
+    levels = subtraction_levels(task_img, min_sub)
+    if not levels:
+        return min_sub
+    # the last level clears the image, nothing is left to subtract
+    lo, hi = -1, len(levels) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        probe = np.copy(task_img)
+        subtract_background(probe, levels[mid])
+        if still_sub(probe):
+            lo = mid
+        else:
+            hi = mid
+    return levels[hi]
+
+
 def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=None, blank_channel=-1,
-                     min_giantin_area=200, giantin_possibility_threshold=0.5, have_overlapping=True):
+                     min_giantin_area=200, giantin_possibility_threshold=0.5, have_overlapping=True,
+                     level_search="step"):
     """
     Check if selected giantin is availiable. Also do bgst.
     :param sub_list: Last time bgst value in each channel. None then first sub.
@@ -330,6 +704,8 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
     :param min_giantin_area: minimum area of giantin
     :param giantin_possibility_threshold: mean possibility of giantin threshold
     :param have_overlapping: giantin channel have overlapping with other channel
+    :param level_search: "step": raise the bgst level by the min nonzero value each round. "bisect": bisect the
+        levels from the intensity histogram for the one that stops the edge / inner circle bgst.
     :return: bgst_golgi, giantin_contour, boolean
     """
     circle_contour = np.array(
@@ -352,13 +728,60 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
     min_sub = 50
     ret_flag = True
     h, w, c = golgi.shape
-    copy_golgi = np.copy(golgi)
+    # channel-planar copy, so each channel is a contiguous image which cv2.drawContours can draw on in place,
+    # whatever the layout of golgi
+    copy_golgi = np.array(golgi.transpose((2, 0, 1)), order="C").transpose((1, 2, 0))
     giantin_contour = None
     giantin_mask = None
     giantin_found = False
     giantin_2_contours_found = False
     if sub_list is None:
         sub_list = [0 for _ in range(c)]
+    if level_search not in ("step", "bisect"):
+        raise Exception("Unknown level_search: {}".format(level_search))
+
+    def giantin_on_edge(task_img):
+        # the same decision as the giantin channel loop below: the one contour left is in the edge
+        contours = sorted(crop_contours(task_img), key=lambda x: cv2.contourArea(x))
+        num_contours = len(contours)
+        for i, contour in enumerate(contours):
+            if cv2.contourArea(contour) <= min_giantin_area:
+                num_contours -= 1
+            elif on_crop_edge(contour, h, w):
+                if num_contours == 1:
+                    return True
+                num_contours -= 1
+            elif num_contours == 1 or i == len(contours) - 1:
+                return False
+            else:
+                num_contours -= 1
+        return False
+
+    def giantin_without_hole(task_img):
+        # only the largest contour is kept, one contour in the tree means the inner circle is not found yet
+        contours = sorted(crop_contours(task_img), key=lambda x: cv2.contourArea(x))
+        if len(contours) == 0:
+            return False
+        for i in range(len(contours) - 1):
+            cv2.drawContours(task_img, contours, i, 0, -1)
+        return len(crop_contours(task_img, cv2.RETR_TREE)) == 1
+
+    def largest_on_edge(task_img):
+        contours = crop_contours(task_img)
+        if len(contours) == 0:
+            return False
+        contour = max(contours, key=lambda x: cv2.contourArea(x))
+        edges = contour_edges(contour, h, w)
+        if not any(edges):
+            return False
+        # rejected by the edge of the roi, not subtracted further
+        return not any(edge and roi_edge for edge, roi_edge in zip(edges, edge_contour))
+
+    def next_sub(task_img, still_sub):
+        if level_search == "bisect":
+            return search_subtraction_level(task_img, still_sub, min_sub)
+        return max(np.min(np.where(task_img > 0, task_img, np.inf)), min_sub)
+
     for c_ in range(c):
         if c_ == blank_channel:
             continue
@@ -368,14 +791,8 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
             if sub > 0:
                 if not giantin_found:
                     sub_list[c_] += sub
-                for i in range(h):
-                    for j in range(w):
-                        if task_img[i][j] > sub:
-                            task_img[i][j] = task_img[i][j] - sub
-                        else:
-                            task_img[i][j] = 0
-            channel_mask = task_img / (task_img + 1) * 255
-            channel_mask = channel_mask.astype(np.uint8)
+                subtract_background(task_img, sub)
+            channel_mask = intensity_mask(task_img)
             _, channel_mask = cv2.threshold(channel_mask, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
             contours, _ = cv2.findContours(channel_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
             num_contours = len(contours)
@@ -402,9 +819,7 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
                         continue
                     else:
                         # clear the contours in the edge
-                        c_x = contour[:, :, 0].reshape(-1, )
-                        c_y = contour[:, :, 1].reshape(-1, )
-                        if h - 1 in c_x or w - 1 in c_y or 0 in c_x or 0 in c_y:
+                        if on_crop_edge(contour, h, w):
                             if num_contours == 1:
                                 # only one contour -> bgst.
                                 do_sub = True
@@ -428,7 +843,7 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
                                 giantin_contour = contour
                                 break
                 if do_sub:
-                    sub = max(np.min(np.where(task_img > 0, task_img, np.inf)), min_sub)
+                    sub = next_sub(task_img, giantin_on_edge)
                     continue
                 if num_contours == 1:
                     if not giantin_found:
@@ -454,8 +869,7 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
                     p_cnt = cv2.arcLength(giantin_contour, True)
                     ratio = p_cnt / p_circle
                     if ratio < 1.05:
-                        channel_mask = task_img / (task_img + 1) * 255
-                        channel_mask = channel_mask.astype(np.uint8)
+                        channel_mask = intensity_mask(task_img)
                         _, channel_mask = cv2.threshold(channel_mask, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
                         # hierachy contours
                         contours, hierachy = cv2.findContours(channel_mask, cv2.RETR_TREE,
@@ -465,7 +879,7 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
                             if giantin_2_contours_found:
                                 # got only one contour due to subtract too large
                                 break
-                            sub = max(np.min(np.where(task_img > 0, task_img, np.inf)), min_sub)
+                            sub = next_sub(task_img, giantin_without_hole)
                             continue
                         elif len(contours) == 2:
                             giantin_2_contours_found = True
@@ -539,26 +953,25 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
                 contours = sorted(contours, key=lambda x: cv2.contourArea(x), reverse=True)
                 max_area = 0
                 for i, contour in enumerate(contours):
-                    c_x = contour[:, :, 0].reshape(-1, )
-                    c_y = contour[:, :, 1].reshape(-1, )
-                    if h - 1 in c_x or w - 1 in c_y or 0 in c_x or 0 in c_y:
+                    left, top, right, bottom = contour_edges(contour, h, w)
+                    if left or top or right or bottom:
                         # right edge
-                        if h - 1 in c_x and edge_contour[2]:
+                        if right and edge_contour[2]:
                             reject_msg = "Contour in channel {} close to the right edge.".format(c_ + 1)
                             ret_flag = False
                             return copy_golgi, _, _, ret_flag, sub_list, reject_msg
                         # bottom edge
-                        if w - 1 in c_y and edge_contour[3]:
+                        if bottom and edge_contour[3]:
                             reject_msg = "Contour in channel {} close to the bottom edge.".format(c_ + 1)
                             ret_flag = False
                             return copy_golgi, _, _, ret_flag, sub_list, reject_msg
                         # left edge
-                        if 0 in c_x and edge_contour[0]:
+                        if left and edge_contour[0]:
                             reject_msg = "Contour in channel {} close to the left edge.".format(c_ + 1)
                             ret_flag = False
                             return copy_golgi, _, _, ret_flag, sub_list, reject_msg
                         # top edge
-                        if 0 in c_y and edge_contour[1]:
+                        if top and edge_contour[1]:
                             reject_msg = "Contour in channel {} close to the top edge.".format(c_ + 1)
                             ret_flag = False
                             return copy_golgi, _, _, ret_flag, sub_list, reject_msg
@@ -581,7 +994,7 @@ def check_golgi_crop(golgi, pred_mask, edge_contour, giantin_channel, sub_list=N
                             num_contours -= 1
                             continue
                 if do_sub:
-                    sub = max(np.min(np.where(task_img > 0, task_img, np.inf)), min_sub)
+                    sub = next_sub(task_img, largest_on_edge)
                     continue
                 # Having overlapping area with giantin channel.
                 if have_overlapping:
@@ -611,12 +1024,11 @@ def cal_center_of_mass(image, contour=None):
     :param contour: Using contour to calculate centroid.
     :return: [(mx, my)]
     """
-    if contour is not None:
-        mu = cv2.moments(contour)
-    else:
+    if contour is None:
         shape_len = len(image.shape)
         assert shape_len == 2, "Dimension of image shape is not 2."
-        mu = cv2.moments(image)
+        return center_of_mass(image)
+    mu = cv2.moments(contour)
     mx = round(mu['m10'] / mu['m00'], 4)
     my = round(mu['m01'] / mu['m00'], 4)
 
@@ -646,16 +1058,8 @@ def cal_gyradius(image, mx, my):
     :return: gyradius
     """
     assert len(image.shape) == 2, "Dimension of image shape is not 2."
-    h, w = image.shape
-    Q = 0
-    total_intensity = 0
-    for i in range(h):
-        for j in range(w):
-            intensity = image[i][j]
-            total_intensity += intensity
-            Q += ((i - my) ** 2 + (j - mx) ** 2) * intensity
-    gyradius = round(np.sqrt(Q / total_intensity), 4)
-    return gyradius
+    # from the row and column sums, see moments.py
+    return gyradius(image, mx, my)
 
 
 def shift_make_border(image, giantin_channel, border_size=(701, 701), center_coord=(350, 350), shift_to_imageJ=True):
@@ -0,0 +1,95 @@
+import numpy as np
+from tifffile import tifffile
+
+
+class LazyImage:
+    """
+    Multichannel TIFF with one page per channel, shape (c,h,w). A channel is decoded only when it is accessed, e.g. the
+    giantin channel for inference, and the other channels when a contour is checked.
+    Decoded channels are kept until release is called.
+    """
+
+    def __init__(self, tif_path):
+        self.tif_path = tif_path
+        with tifffile.TiffFile(tif_path) as tif:
+            series = tif.series[0]
+            self.shape = tuple(series.shape)
+            self.dtype = series.dtype
+        self.ndim = len(self.shape)
+        self.planes = {}
+
+    def get_plane(self, channel):
+        if channel < 0:
+            channel += self.shape[0]
+        if channel not in self.planes:
+            with tifffile.TiffFile(self.tif_path) as tif:
+                self.planes[channel] = tif.series[0].pages[channel].asarray()
+        return self.planes[channel]
+
+    def release(self):
+        self.planes = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.get_plane(int(key))
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None):
+        image = np.stack([self.get_plane(c) for c in range(self.shape[0])], axis=0)
+        return image if dtype is None else image.astype(dtype)
+
+    def transpose(self, axes):
+        if tuple(axes) == (1, 2, 0):
+            return ChannelLastView(self)
+        return np.asarray(self).transpose(axes)
+
+
+class ChannelLastView:
+    """
+    (h,w,c) view of a LazyImage, as used by analysis_golgi. A crop only decodes the channels it needs.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        c, h, w = image.shape
+        self.shape = (h, w, c)
+        self.dtype = image.dtype
+        self.ndim = 3
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        channels = range(self.shape[2])[key[2]]
+        if isinstance(channels, int):
+            return self.image.get_plane(channels)[key[0], key[1]]
+        # channel-planar like a crop of the (c,h,w) ndarray transposed, so each channel is contiguous
+        return np.stack([self.image.get_plane(c)[key[0], key[1]] for c in channels], axis=0).transpose((1, 2, 0))
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.image, dtype=dtype).transpose((1, 2, 0))
+
+
+def open_image(tif_path):
+    """
+    Open a golgi image without decoding it.
+    Uncompressed TIFFs are memory-mapped. Compressed TIFFs with one page per channel are decoded per channel.
+    Other layouts are read as usual.
+    :return: memmap, LazyImage or ndarray, shape (c,h,w)
+    """
+    try:
+        return tifffile.memmap(tif_path, mode="r")
+    except ValueError:
+        pass
+    with tifffile.TiffFile(tif_path) as tif:
+        series = tif.series[0]
+        per_channel = len(series.shape) == 3 and len(series.pages) == series.shape[0]
+    if per_channel:
+        return LazyImage(tif_path)
+    return tifffile.imread(tif_path)
+
+
+def release_image(golgi_image):
+    # drop decoded channels, they are decoded again when the image is analysed again
+    if isinstance(golgi_image, LazyImage):
+        golgi_image.release()
@@ -0,0 +1,274 @@
+import argparse
+import logging
+import os.path
+
+import numpy as np
+import tensorflow as tf
+import tifffile
+from keras.models import load_model, Model
+
+from pred_cache import atomic_write
+from image_functions import padding_image, make_model_input, batch_predict, pred_to_mask, unpadding_image, \
+    get_patch_grid, predict_whole_image
+
+# valDice0.7042_valMeanIoU0.5532.h5
+model_path = "./model/model.h5"
+# inference-only artifact converted from model_path
+saved_model_path = "./model/inference_model"
+# TFLite flatbuffer converted from model_path
+tflite_model_path = "./model/model.tflite"
+patch_shape = (256, 256, 1)
+
+
+def convert_to_saved_model(h5_path=model_path, export_path=saved_model_path, jit_compile=False):
+    """
+    Convert the trained .h5 model to an inference-only SavedModel with a fixed (None, 256, 256, 1) signature.
+    No optimizer, loss or metrics are saved.
+    :param h5_path: trained keras model
+    :param export_path: output SavedModel folder
+    :param jit_compile: compile the forward pass with XLA
+    :return: export_path
+    """
+    model = load_model(h5_path, compile=False)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,) + patch_shape, dtype=tf.float32, name="patches")],
+                 jit_compile=jit_compile)
+    def predict(patches):
+        return model(patches, training=False)
+
+    module = tf.Module()
+    module.model = model
+    module.predict = predict
+    tf.saved_model.save(module, export_path, signatures={"serving_default": predict})
+    return export_path
+
+
+class InferenceModel:
+    """
+    Inference-only model loaded from convert_to_saved_model output.
+    It has the predict_on_batch interface used by batch_predict.
+    """
+
+    def __init__(self, export_path=saved_model_path):
+        self.loaded = tf.saved_model.load(export_path)
+        self.predict_func = self.loaded.predict
+
+    def predict_on_batch(self, batch):
+        return self.predict_func(tf.convert_to_tensor(batch, dtype=tf.float32)).numpy()
+
+
+def convert_to_tflite(h5_path=model_path, export_path=tflite_model_path):
+    """
+    Convert the trained .h5 model to a float TFLite flatbuffer.
+    :param h5_path: trained keras model
+    :param export_path: output .tflite file
+    :return: export_path
+    """
+    model = load_model(h5_path, compile=False)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    flatbuffer = converter.convert()
+    # other processes loading the model never read a half-written file
+    atomic_write(export_path, lambda f: f.write(flatbuffer))
+    return export_path
+
+
+def ensure_tflite_model():
+    """
+    Convert the .h5 model at the first tflite run. Called before worker processes start, so they do not all convert it.
+    :return: tflite_model_path
+    """
+    if not os.path.exists(tflite_model_path):
+        convert_to_tflite(model_path, tflite_model_path)
+    return tflite_model_path
+
+
+class TFLiteModel:
+    """
+    TFLite backend with the predict_on_batch interface used by batch_predict.
+    The builtin op resolver applies the XNNPACK delegate to float models, num_threads is used by XNNPACK.
+    """
+
+    def __init__(self, export_path=tflite_model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=export_path, num_threads=num_threads,
+                                               experimental_op_resolver_type=
+                                               tf.lite.experimental.OpResolverType.BUILTIN)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict_on_batch(self, batch):
+        # batch_predict keeps the batch size fixed, so tensors are only allocated once.
+        if len(batch) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, (len(batch),) + patch_shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(batch)
+        self.interpreter.set_tensor(self.input_index, np.asarray(batch, dtype=np.float32))
+        self.interpreter.invoke()
+        return np.copy(self.interpreter.get_tensor(self.output_index))
+
+
+def make_fully_convolutional(model):
+    """
+    Rebuild a keras model with input shape (None, None, None, 1) and the same weights,
+    so it can predict a whole image whose sides are multiple of 16.
+    """
+    config = model.get_config()
+    config["layers"][0]["config"]["batch_input_shape"] = (None, None, None, patch_shape[-1])
+    fcn_model = Model.from_config(config)
+    fcn_model.set_weights(model.get_weights())
+    return fcn_model
+
+
+def warm_up(model, batch_size=1):
+    """
+    Run one batch of zeros so graph tracing is not paid by the first image.
+    """
+    model.predict_on_batch(np.zeros((batch_size,) + patch_shape, dtype=np.float32))
+
+
+def get_model_file(backend="keras", fully_convolutional=False):
+    """
+    File of the model loaded by load_inference_model, e.g. to hash it.
+    """
+    if fully_convolutional:
+        return model_path
+    if backend == "tflite":
+        return tflite_model_path if os.path.exists(tflite_model_path) else model_path
+    return saved_model_path if os.path.exists(saved_model_path) else model_path
+
+
+def load_inference_model(backend="keras", batch_size=1, num_threads=None, warmup=True, fully_convolutional=False):
+    """
+    Load the model of an inference backend.
+    keras: the inference-only SavedModel if it exists, otherwise the .h5 model without compiling it.
+    tflite: the TFLite flatbuffer, converted from the .h5 model at the first time.
+    :param backend: "keras" or "tflite"
+    :param batch_size: batch size of the warm-up pass, the same as the one used in prediction.
+    :param num_threads: no. of threads of the tflite backend, None for TFLite default.
+    :param warmup: run a warm-up pass
+    :param fully_convolutional: keras model without fixed input size, for whole-image inference.
+    :return: model with predict_on_batch
+    """
+    if fully_convolutional:
+        if backend != "keras":
+            raise Exception("Whole-image inference only supports keras backend.")
+        if not os.path.exists(model_path):
+            raise Exception("No such model file:{}".format(model_path))
+        model = make_fully_convolutional(load_model(model_path, compile=False))
+    elif backend == "tflite":
+        model = TFLiteModel(ensure_tflite_model(), num_threads=num_threads)
+    elif backend != "keras":
+        raise Exception("Unknown inference backend:{}".format(backend))
+    elif os.path.exists(saved_model_path):
+        model = InferenceModel(saved_model_path)
+    elif os.path.exists(model_path):
+        model = load_model(model_path, compile=False)
+    else:
+        raise Exception("No such model file:{}".format(model_path))
+    if warmup:
+        warm_up(model, batch_size)
+    return model
+
+
+def mask_dice_iou(mask_a, mask_b):
+    intersection = np.logical_and(mask_a, mask_b).sum()
+    total = mask_a.sum() + mask_b.sum()
+    union = total - intersection
+    # two empty masks are the same
+    dice = 2 * intersection / total if total > 0 else 1.0
+    iou = intersection / union if union > 0 else 1.0
+    return dice, iou
+
+
+def predict_images(model, giantin_image_list, batch_size=32, mode="patch"):
+    """
+    Predict full-size probability maps, the same way as Progress.pipeline does.
+    :param mode: "patch" or "whole", inference_mode of Progress. model of "whole" is fully convolutional.
+    """
+    if mode == "whole":
+        return [predict_whole_image(model, image) for image in giantin_image_list]
+    padded_list, patches_list = padding_image(giantin_image_list, do_patchify=True, clear_edge_roi=False,
+                                              patch_size=(256, 256), patch_step=206)
+    grid_shape_list = [get_patch_grid(padded.shape, patch_size=(256, 256), patch_step=206) for padded in padded_list]
+    model_input = make_model_input(patches_list, do_norm=True, data_shape=(-1,) + patch_shape)
+    model_pred = [pred for _, pred in batch_predict(model, model_input, batch_size=batch_size)]
+    pred_mask, _ = pred_to_mask(model_pred, grid_shape_list=grid_shape_list)
+    return unpadding_image(pred_mask, giantin_image_list)
+
+
+def check_backend_parity(reference_model, test_model, giantin_image_list, pixel_threshold=0.5, batch_size=32,
+                         test_mode="patch"):
+    """
+    Compare the thresholded masks of two backends, or of patch and whole-image inference, on sample images.
+    :param reference_model: e.g. keras backend
+    :param test_model: e.g. tflite backend, or fully convolutional keras model with test_mode "whole"
+    :param giantin_image_list: sample giantin images
+    :param pixel_threshold: the same as param_pixel_threshold
+    :param batch_size:
+    :param test_mode: inference mode of test_model, the reference is predicted in patches
+    :return: list of (dice, iou, max abs probability difference) per image
+    """
+    reference_pred = predict_images(reference_model, giantin_image_list, batch_size)
+    test_pred = predict_images(test_model, giantin_image_list, batch_size, mode=test_mode)
+    result = []
+    for ref, test in zip(reference_pred, test_pred):
+        dice, iou = mask_dice_iou(ref > pixel_threshold, test > pixel_threshold)
+        result.append((dice, iou, float(np.abs(ref - test).max())))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the trained model to an inference backend, "
+                                                 "or check the masks of the tflite backend or of whole-image "
+                                                 "inference against keras patches.")
+    parser.add_argument("--model", default=model_path, help="trained .h5 model")
+    parser.add_argument("--backend", default="saved_model", choices=["saved_model", "tflite"])
+    parser.add_argument("--output", default=None, help="output SavedModel folder or .tflite file")
+    parser.add_argument("--xla", action="store_true", help="compile the forward pass with XLA")
+    parser.add_argument("--parity", default=None, help="folder of sample .tif images to check tflite parity")
+    parser.add_argument("--whole", action="store_true",
+                        help="with --parity, check whole-image inference against patches instead of tflite")
+    parser.add_argument("--giantin_channel", type=int, default=1, help="giantin channel, start from 1")
+    parser.add_argument("--threads", type=int, default=None, help="no. of tflite threads")
+    parser.add_argument("--tflite", default=None, help=".tflite file to check, e.g. the int8 quantized model")
+    parser.add_argument("--pixel_threshold", type=float, default=0.5)
+    args = parser.parse_args()
+    if args.parity is not None:
+        golgi_image_list = []
+        for file in sorted(os.listdir(args.parity)):
+            if file.endswith(".tif"):
+                golgi_image_list.append(tifffile.imread(os.path.join(args.parity, file)))
+        sample_list = [golgi_image[args.giantin_channel - 1] for golgi_image in golgi_image_list]
+        keras_model = load_inference_model("keras")
+        test_mode = "whole" if args.whole else "patch"
+        if args.whole:
+            test_model = load_inference_model("keras", fully_convolutional=True)
+            test_name = "whole"
+        elif args.tflite is not None:
+            test_model = TFLiteModel(args.tflite, num_threads=args.threads)
+            test_name = "tflite"
+        else:
+            test_model = load_inference_model("tflite", num_threads=args.threads)
+            test_name = "tflite"
+        for i, (dice, iou, max_diff) in enumerate(check_backend_parity(keras_model, test_model, sample_list,
+                                                                       args.pixel_threshold,
+                                                                       test_mode=test_mode)):
+            print("image {}: dice {:.4f}, iou {:.4f}, max probability difference {:.4f}".format(i, dice, iou,
+                                                                                                max_diff))
+        # accepted mini-stacks with the default parameters of the GUI. processing imports this module.
+        from processing import Progress
+        progress = Progress(model=keras_model, logger=logging.getLogger(), image_path_list=[],
+                            param_pixel_threshold=args.pixel_threshold, param_giantin_threshold=0.6,
+                            param_giantin_area_threshold=150, param_giantin_roi_size=50,
+                            param_giantin_channel=args.giantin_channel - 1, param_blank_channel=-2,
+                            param_giantin_overlap=True, pred_data=None, golgi_images=None)
+        num_reference, num_test, num_changed = progress.compare_ministacks(
+            golgi_image_list, predict_images(keras_model, sample_list),
+            predict_images(test_model, sample_list, mode=test_mode))
+        print("accepted mini-stacks: keras {}, {} {}, changed {}".format(num_reference, test_name, num_test,
+                                                                        num_changed))
+    elif args.backend == "tflite":
+        print("Saved to {}".format(convert_to_tflite(args.model, args.output or tflite_model_path)))
+    else:
+        print("Saved to {}".format(convert_to_saved_model(args.model, args.output or saved_model_path,
+                                                          jit_compile=args.xla)))
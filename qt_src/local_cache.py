@@ -0,0 +1,122 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LocalFileCache:
+    """
+    Read-through cache of input files on a local disk, for images on slow network shares.
+    Files are copied in the background ahead of the pipeline, verified by checksum, and evicted least recently used
+    (by access time) first when the cache is larger than max_size_mb. A copy is keyed by the source path, size and mtime, so a changed
+    source file is copied again.
+    """
+
+    def __init__(self, cache_dir, max_size_mb, num_threads=2, chunk_size=1 << 22):
+        """
+        :param cache_dir: local cache folder, e.g. on an SSD
+        :param max_size_mb: max total size of the copies
+        :param num_threads: no. of background copy threads
+        :param chunk_size: bytes per read from the source
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.chunk_size = chunk_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="local-cache")
+        self.lock = threading.Lock()
+        # source path: future of its local path
+        self.futures = {}
+
+    def get_cache_path(self, src_path):
+        stat = os.stat(src_path)
+        key = "{}|{}|{}".format(os.path.realpath(src_path), stat.st_size, stat.st_mtime_ns)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + os.path.splitext(src_path)[1])
+
+    def copy(self, src_path, cache_path):
+        """
+        Stream src_path to cache_path, and check the checksum of the copy against the source stream.
+        """
+        src_sha1 = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with open(src_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                for chunk in iter(lambda: src.read(self.chunk_size), b""):
+                    src_sha1.update(chunk)
+                    dst.write(chunk)
+            dst_sha1 = hashlib.sha1()
+            with open(tmp_path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                    dst_sha1.update(chunk)
+            if dst_sha1.hexdigest() != src_sha1.hexdigest():
+                raise Exception("Checksum of the local copy of {} does not match.".format(src_path))
+            # a complete copy appears at once
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def fetch(self, src_path):
+        cache_path = self.get_cache_path(src_path)
+        if os.path.exists(cache_path):
+            # mark as recently used by the access time. The mtime is kept, it keys the file hash memo of the copy.
+            os.utime(cache_path, ns=(time.time_ns(), os.stat(cache_path).st_mtime_ns))
+            return cache_path
+        self.copy(src_path, cache_path)
+        self.evict(keep=cache_path)
+        return cache_path
+
+    def prefetch(self, src_path_list):
+        """
+        Copy files in the background, in order.
+        """
+        with self.lock:
+            for src_path in src_path_list:
+                if src_path not in self.futures:
+                    self.futures[src_path] = self.executor.submit(self.fetch, src_path)
+
+    def get(self, src_path):
+        """
+        :return: path of the local copy, waits for a background copy or copies now.
+        """
+        with self.lock:
+            future = self.futures.pop(src_path, None)
+        if future is not None:
+            return future.result()
+        return self.fetch(src_path)
+
+    def evict(self, keep=None):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file)
+            if file.endswith(".tmp") or path == keep:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        total_size = sum(entry[1] for entry in entries)
+        if keep is not None:
+            total_size += os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # in use, e.g. memory-mapped on Windows
+                continue
+            total_size -= size
+
+    def close(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+        self.executor.shutdown(wait=True)
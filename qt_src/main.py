@@ -1,5 +1,6 @@
 # v2.3
 import configparser
+import multiprocessing
 import os.path
 import sys
 import re
@@ -13,7 +14,10 @@ from PyQt5.QtWidgets import QMainWindow, QApplication, QVBoxLayout, QGridLayout,
 from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle
 
+from archive import is_archive, list_archive_tifs, source_name
+from manifest import FileManifest
 from processing import Progress
+from pred_store import to_pred_array
 from utils import *
 
 from qt_ui.mainUI import Ui_MainWindow
@@ -44,6 +48,9 @@ class MainWindow(QMainWindow):
         self.model = None
         self.pred_data = None
         self.golgi_images = None
+        self.analysis_memo = None
+        # cached listings of the input folders, shared with Progress
+        self.manifest = FileManifest()
         self.pred_flag = True
         self.save_directory = ""
         self.exp_name = ""
@@ -133,19 +140,24 @@ class MainWindow(QMainWindow):
                 return
             first_path = first_item.text()
         file_name = os.path.split(first_path)[1]
+        if is_archive(first_path):
+            # channel names from the first image in the archive
+            member_list = list_archive_tifs(first_path)
+            if len(member_list) == 0:
+                return
+            file_name = source_name(member_list[0])
         if not os.path.isfile(first_path):
-            for _, _, files in os.walk(first_path):
-                for file in files:
-                    if file.endswith(".tif"):
-                        file_name = file
-                        file_name_split_list = re.split('[-_]', file_name)
-                        self.ui.comboBox_c1.clear()
-                        self.ui.comboBox_c1.addItems(file_name_split_list)
-                        self.ui.comboBox_c2.clear()
-                        self.ui.comboBox_c2.addItems(file_name_split_list)
-                        self.ui.comboBox_c3.clear()
-                        self.ui.comboBox_c3.addItems(file_name_split_list)
-                        return
+            # only the first .tif is needed, the rest of the folder is not listed
+            for tif_path in self.manifest.walk_tifs(first_path):
+                file_name = os.path.split(tif_path)[1]
+                file_name_split_list = re.split('[-_]', file_name)
+                self.ui.comboBox_c1.clear()
+                self.ui.comboBox_c1.addItems(file_name_split_list)
+                self.ui.comboBox_c2.clear()
+                self.ui.comboBox_c2.addItems(file_name_split_list)
+                self.ui.comboBox_c3.clear()
+                self.ui.comboBox_c3.addItems(file_name_split_list)
+                return
         else:
             file_name_split_list = re.split('[-_]', file_name)
             self.ui.comboBox_c1.clear()
@@ -203,6 +215,44 @@ class MainWindow(QMainWindow):
             self.param_dict["param_giantin_overlap"] = param_giantin_overlap
             self.ui.param_giantin_overlap.setChecked(param_giantin_overlap)
 
+            # inference params without UI, only set by config file.
+            self.param_dict["inference_memory_budget"] = self.cfg.getint("inference", "memory_budget",
+                                                                         fallback=1024)
+            self.param_dict["pipeline_queue_size"] = self.cfg.getint("inference", "pipeline_queue_size", fallback=2)
+            self.param_dict["inference_backend"] = self.cfg.get("inference", "backend", fallback="keras")
+            inference_threads = self.cfg.getint("inference", "threads", fallback=0)
+            self.param_dict["inference_threads"] = inference_threads if inference_threads > 0 else None
+            self.param_dict["inference_mode"] = self.cfg.get("inference", "mode", fallback="patch")
+            self.param_dict["skip_background"] = self.cfg.getboolean("inference", "skip_background", fallback=True)
+            self.param_dict["min_foreground_pixels"] = self.cfg.getint("inference", "min_foreground_pixels",
+                                                                       fallback=1)
+            self.param_dict["coarse_to_fine"] = self.cfg.getboolean("inference", "coarse_to_fine", fallback=False)
+            self.param_dict["coarse_downsample"] = self.cfg.getint("inference", "coarse_downsample", fallback=4)
+            self.param_dict["mosaic_min_pixels"] = self.cfg.getint("inference", "mosaic_min_pixels",
+                                                                   fallback=10000 * 10000)
+            self.param_dict["mosaic_dir"] = self.cfg.get("inference", "mosaic_dir", fallback=None)
+            self.param_dict["num_workers"] = self.cfg.getint("inference", "workers", fallback=0)
+            self.param_dict["worker_intra_op_threads"] = self.cfg.getint("inference", "worker_intra_op_threads",
+                                                                         fallback=1)
+            self.param_dict["worker_inter_op_threads"] = self.cfg.getint("inference", "worker_inter_op_threads",
+                                                                         fallback=1)
+            self.param_dict["pred_cache_dir"] = self.cfg.get("inference", "pred_cache_dir", fallback=None)
+            self.param_dict["pred_cache_size_mb"] = self.cfg.getint("inference", "pred_cache_size_mb", fallback=4096)
+            self.param_dict["lazy_load"] = self.cfg.getboolean("inference", "lazy_load", fallback=True)
+            self.param_dict["read_threads"] = self.cfg.getint("inference", "read_threads", fallback=4)
+            self.param_dict["dedup_by_content"] = self.cfg.getboolean("inference", "dedup_by_content",
+                                                                      fallback=False)
+            self.param_dict["preflight"] = self.cfg.getboolean("inference", "preflight", fallback=True)
+            self.param_dict["local_cache_dir"] = self.cfg.get("inference", "local_cache_dir", fallback=None)
+            self.param_dict["local_cache_size_mb"] = self.cfg.getint("inference", "local_cache_size_mb",
+                                                                     fallback=20480)
+            self.param_dict["compact_pred"] = self.cfg.getboolean("inference", "compact_pred", fallback=True)
+            self.param_dict["compact_pred_crop"] = self.cfg.getboolean("inference", "compact_pred_crop",
+                                                                       fallback=False)
+            self.param_dict["subtraction_search"] = self.cfg.get("analysis", "subtraction_search", fallback="step")
+            self.param_dict["early_reject"] = self.cfg.getboolean("analysis", "early_reject", fallback=True)
+            self.param_dict["heuristic_reject"] = self.cfg.getboolean("analysis", "heuristic_reject", fallback=False)
+
             path_list = self.cfg.get("path", "path").split(";")
             self.param_dict["path_list"] = path_list
             self.listview_image_path.addItems(path_list)
@@ -303,6 +353,7 @@ class MainWindow(QMainWindow):
         self.pred_flag = self.progress.get_pred_flag()
         self.model = self.progress.get_model()
         self.pred_data = self.progress.get_pred_data()
+        self.analysis_memo = self.progress.get_analysis_memo()
         self.golgi_images = self.progress.get_golgi_images()
         tmp_tif_name_list = self.progress.get_tif_name_list()
         tmp_tif_folder_list = self.progress.get_tif_folder_list()
@@ -362,7 +413,36 @@ class MainWindow(QMainWindow):
                                      param_giantin_channel=self.param_dict["param_giantin_channel"],
                                      param_blank_channel=self.param_dict["param_blank_channel"],
                                      param_giantin_overlap=self.param_dict["param_giantin_overlap"],
-                                     pred_flag=self.pred_flag, pred_data=self.pred_data, golgi_images=self.golgi_images)
+                                     pred_flag=self.pred_flag, pred_data=self.pred_data, golgi_images=self.golgi_images,
+                                     inference_memory_budget=self.param_dict.get("inference_memory_budget", 1024),
+                                     pipeline_queue_size=self.param_dict.get("pipeline_queue_size", 2),
+                                     inference_backend=self.param_dict.get("inference_backend", "keras"),
+                                     inference_threads=self.param_dict.get("inference_threads"),
+                                     inference_mode=self.param_dict.get("inference_mode", "patch"),
+                                     skip_background=self.param_dict.get("skip_background", True),
+                                     min_foreground_pixels=self.param_dict.get("min_foreground_pixels", 1),
+                                     coarse_to_fine=self.param_dict.get("coarse_to_fine", False),
+                                     coarse_downsample=self.param_dict.get("coarse_downsample", 4),
+                                     mosaic_min_pixels=self.param_dict.get("mosaic_min_pixels", 10000 * 10000),
+                                     mosaic_dir=self.param_dict.get("mosaic_dir"),
+                                     num_workers=self.param_dict.get("num_workers", 0),
+                                     worker_intra_op_threads=self.param_dict.get("worker_intra_op_threads", 1),
+                                     worker_inter_op_threads=self.param_dict.get("worker_inter_op_threads", 1),
+                                     pred_cache_dir=self.param_dict.get("pred_cache_dir"),
+                                     pred_cache_size_mb=self.param_dict.get("pred_cache_size_mb", 4096),
+                                     analysis_memo=self.analysis_memo,
+                                     compact_pred=self.param_dict.get("compact_pred", True),
+                                     compact_pred_crop=self.param_dict.get("compact_pred_crop", False),
+                                     lazy_load=self.param_dict.get("lazy_load", True),
+                                     read_threads=self.param_dict.get("read_threads", 4),
+                                     manifest=self.manifest,
+                                     dedup_by_content=self.param_dict.get("dedup_by_content", False),
+                                     preflight=self.param_dict.get("preflight", True),
+                                     local_cache_dir=self.param_dict.get("local_cache_dir"),
+                                     local_cache_size_mb=self.param_dict.get("local_cache_size_mb", 20480),
+                                     subtraction_search=self.param_dict.get("subtraction_search", "step"),
+                                     early_reject=self.param_dict.get("early_reject", True),
+                                     heuristic_reject=self.param_dict.get("heuristic_reject", False))
 
             self.progress.moveToThread(self.thread)
             self.start_backgroung_work.connect(self.progress.pipeline)
@@ -723,7 +803,7 @@ class MainWindow(QMainWindow):
                     replicate_time += 1
                     file_name = "pred_{}({})".format(self.tif_name_list[n], replicate_time)
                     file_path = os.path.join(save_path, file_name+".tif")
-                tifffile.imsave(file_path, pred)
+                tifffile.imsave(file_path, to_pred_array(pred))
             open_folder_func(save_path)
         except Exception as e:
             err_msg = "Saving pred images Error: {}".format(e)
@@ -734,6 +814,8 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == '__main__':
+    # worker processes of the packaged app
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     ratio = app.primaryScreen().logicalDotsPerInch() / 96
     new_font_size = 9 / ratio + 0.5
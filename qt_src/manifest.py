@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+
+from tifffile import tifffile
+
+from archive import open_source, stat_source, source_exists, is_member_path
+from pred_cache import atomic_write, hash_source
+
+manifest_path = os.path.join(os.path.expanduser("~"), ".enface_manifest.json")
+
+
+class FileManifest:
+    """
+    Cache of the input folders: .tif listings of every directory, validated by the directory's mtime, and TIFF header
+    metadata, validated by the file's size and mtime. A rescan only stats the directories, unchanged ones are not
+    listed again.
+    """
+
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = False
+        self.dirs = {}
+        self.headers = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    manifest = json.load(f)
+                self.dirs = manifest["dirs"]
+                self.headers = manifest["headers"]
+            except (ValueError, KeyError):
+                # broken manifest, folders are scanned again
+                self.dirs = {}
+                self.headers = {}
+
+    def list_dir(self, path):
+        """
+        :return: dict of .tif file names and sub directory names, in the order of os.walk
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            listing = self.dirs.get(path)
+            if listing is not None and listing["mtime_ns"] == mtime_ns:
+                return listing
+            listing = {"mtime_ns": mtime_ns, "files": [], "dirs": []}
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    # like os.walk, symlinks to directories are not followed
+                    if not entry.is_symlink():
+                        listing["dirs"].append(entry.name)
+                elif entry.name.endswith(".tif"):
+                    listing["files"].append(entry.name)
+        except OSError:
+            # like os.walk, unreadable directories are skipped
+            return {"mtime_ns": None, "files": [], "dirs": []}
+        with self.lock:
+            self.dirs[path] = listing
+            self.changed = True
+        return listing
+
+    def walk_tifs(self, path):
+        """
+        Generator of the .tif files in path and its sub directories, in the same order as os.walk.
+        """
+        listing = self.list_dir(path)
+        for file in listing["files"]:
+            yield os.path.join(path, file)
+        for sub_dir in listing["dirs"]:
+            yield from self.walk_tifs(os.path.join(path, sub_dir))
+
+    def get_header(self, tif_path):
+        """
+        Header metadata without decoding pixels.
+        :return: dict of shape, dtype and no. of pages
+        """
+        real_path, size, mtime_ns = stat_source(tif_path)
+        header = self.headers.get(real_path)
+        if header is None or header["size"] != size or header["mtime_ns"] != mtime_ns:
+            with tifffile.TiffFile(open_source(real_path)) as tif:
+                series = tif.series[0]
+                header = {"size": size, "mtime_ns": mtime_ns, "shape": list(series.shape),
+                          "dtype": str(series.dtype), "pages": len(series.pages)}
+            with self.lock:
+                self.headers[real_path] = header
+                self.changed = True
+        return header
+
+    @staticmethod
+    def remove_duplicates(tif_path_list, by_content=False):
+        """
+        Keep the first of the paths to the same file, e.g. a folder selected twice or a symlink. With by_content,
+        copies with the same content are also removed, only files of the same size and archive members are hashed.
+        :return: list of unique paths, in input order
+        """
+        seen = set()
+        unique_list = []
+        for tif_path in tif_path_list:
+            real_path = stat_source(tif_path)[0]
+            if real_path not in seen:
+                seen.add(real_path)
+                unique_list.append(tif_path)
+        if not by_content:
+            return unique_list
+        # the size of an archive member is unknown without reading it
+        size_list = [None if is_member_path(tif_path) else os.path.getsize(tif_path) for tif_path in unique_list]
+        sizes = {}
+        for size in size_list:
+            sizes[size] = sizes.get(size, 0) + 1
+        seen = set()
+        content_list = []
+        for tif_path, size in zip(unique_list, size_list):
+            if size is None or sizes[size] > 1:
+                content_key = hash_source(tif_path)
+                if content_key in seen:
+                    continue
+                seen.add(content_key)
+            content_list.append(tif_path)
+        return content_list
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            # drop the entries of deleted files and folders
+            self.dirs = {path: listing for path, listing in self.dirs.items() if os.path.isdir(path)}
+            self.headers = {path: header for path, header in self.headers.items() if source_exists(path)}
+            data = json.dumps({"dirs": self.dirs, "headers": self.headers}).encode()
+            self.changed = False
+        atomic_write(self.path, lambda f: f.write(data))
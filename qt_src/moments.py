@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def stack_crops(crops):
+    """
+    Stack crops of different shapes, zero-padded at the bottom and right. Zero pixels add nothing to the moments.
+    :param crops: list of (h,w) images
+    :return: (n,h,w) array
+    """
+    max_h = max(crop.shape[0] for crop in crops)
+    max_w = max(crop.shape[1] for crop in crops)
+    stacked = np.zeros((len(crops), max_h, max_w), dtype=np.result_type(*crops))
+    for i, crop in enumerate(crops):
+        stacked[i, :crop.shape[0], :crop.shape[1]] = crop
+    return stacked
+
+
+def intensity_projections(images):
+    """
+    Row and column sums of the intensity, exact for integer images. All moments up to the second order of an image
+    follow from them.
+    :param images: (h,w) image, (n,h,w) batch or list of crops
+    :return: row sums (n,h), column sums (n,w), as float64
+    """
+    if isinstance(images, (list, tuple)):
+        images = stack_crops(images)
+    images = np.asarray(images)
+    assert images.ndim in (2, 3), "Dimension of image shape is not 2."
+    if images.ndim == 2:
+        images = images[np.newaxis]
+    sum_dtype = np.int64 if np.issubdtype(images.dtype, np.integer) or images.dtype == np.bool_ else np.float64
+    row_sums = images.sum(axis=2, dtype=sum_dtype)
+    col_sums = images.sum(axis=1, dtype=sum_dtype)
+    return row_sums.astype(np.float64), col_sums.astype(np.float64)
+
+
+def unbatch(values, images):
+    if isinstance(images, (list, tuple)) or np.ndim(images) == 3:
+        return values
+    return values[0]
+
+
+def cal_moments(images, centers=None):
+    """
+    Center of mass and gyradius from one pass over the pixels, rounded to 4 decimals like cal_center_of_mass and
+    cal_gyradius. sum(((i - my) ** 2 + (j - mx) ** 2) * intensity) splits into the row sums weighted by (i - my) ** 2
+    and the column sums weighted by (j - mx) ** 2.
+    :param images: (h,w) image, (n,h,w) batch or list of crops
+    :param centers: (mx, my) to take the gyradius around, e.g. of the giantin contour. None for the center of mass.
+    :return: mx, my, gyradius. Arrays of n for a batch.
+    """
+    row_sums, col_sums = intensity_projections(images)
+    total_intensity = row_sums.sum(axis=1)
+    ys = np.arange(row_sums.shape[1], dtype=np.float64)
+    xs = np.arange(col_sums.shape[1], dtype=np.float64)
+    if centers is None:
+        mx = np.round(col_sums @ xs / total_intensity, 4)
+        my = np.round(row_sums @ ys / total_intensity, 4)
+    else:
+        mx = np.broadcast_to(np.asarray(centers[0], dtype=np.float64), total_intensity.shape)
+        my = np.broadcast_to(np.asarray(centers[1], dtype=np.float64), total_intensity.shape)
+    q = (row_sums * (ys - my[:, np.newaxis]) ** 2).sum(axis=1) + (col_sums * (xs - mx[:, np.newaxis]) ** 2).sum(axis=1)
+    radius = np.round(np.sqrt(q / total_intensity), 4)
+    return unbatch(mx, images), unbatch(my, images), unbatch(radius, images)
+
+
+def center_of_mass(images):
+    """
+    :param images: (h,w) image, (n,h,w) batch or list of crops
+    :return: mx, my. Arrays of n for a batch.
+    """
+    mx, my, _ = cal_moments(images)
+    return mx, my
+
+
+def gyradius(images, mx, my):
+    """
+    :param images: (h,w) image, (n,h,w) batch or list of crops
+    :param mx: center of mass in x-axis, array of n for a batch
+    :param my: center of mass in y-axis, array of n for a batch
+    :return: gyradius, array of n for a batch
+    """
+    return cal_moments(images, centers=(mx, my))[2]
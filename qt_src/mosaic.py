@@ -0,0 +1,95 @@
+import os.path
+
+import cv2
+import numpy as np
+from tifffile import tifffile
+
+from inference import predict_images
+
+
+def get_image_shape(tif_path):
+    """
+    Shape of the image from the TIFF header, without reading pixels.
+    """
+    with tifffile.TiffFile(tif_path) as tif:
+        return tif.series[0].shape
+
+
+def open_mosaic(tif_path):
+    """
+    Memory-map a mosaic, so tiles are read from disk only when they are sliced.
+    :param tif_path: uncompressed multichannel TIFF
+    :return: memmap, shape (c,h,w)
+    """
+    try:
+        return tifffile.memmap(tif_path, mode="r")
+    except ValueError as e:
+        raise Exception("{} can not be memory-mapped, a mosaic must be an uncompressed TIFF: {}".format(tif_path, e))
+
+
+def predict_mosaic(model, golgi_image, giantin_channel, pred_path, tile_size=4096, halo=128, batch_size=32):
+    """
+    Predict a mosaic tile by tile. The giantin channel is read tile by tile, and the probability map is written to
+    a disk-backed .npy memmap, so peak memory is bounded by the tile size.
+    :param model: model with predict_on_batch
+    :param golgi_image: memmap, shape (c,h,w)
+    :param giantin_channel:
+    :param pred_path: .npy file of the probability map
+    :param tile_size: side of one tile
+    :param halo: context pixels around each tile, dropped from the output
+    :param batch_size:
+    :return: probability map, read-only memmap, shape (h,w)
+    """
+    _, h, w = golgi_image.shape
+    pred_map = np.lib.format.open_memmap(pred_path, mode="w+", dtype=np.float32, shape=(h, w))
+    for y0 in range(0, h, tile_size):
+        for x0 in range(0, w, tile_size):
+            y1 = min(y0 + tile_size, h)
+            x1 = min(x0 + tile_size, w)
+            ty0, tx0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            ty1, tx1 = min(y1 + halo, h), min(x1 + halo, w)
+            tile = np.asarray(golgi_image[giantin_channel, ty0:ty1, tx0:tx1])
+            if tile.max() == tile.min():
+                # empty tile, pred_map is zero-filled
+                continue
+            tile_pred = predict_images(model, [tile], batch_size=batch_size)[0]
+            pred_map[y0:y1, x0:x1] = tile_pred[y0 - ty0:y1 - ty0, x0 - tx0:x1 - tx0]
+    pred_map.flush()
+    del pred_map
+    return np.load(pred_path, mmap_mode="r")
+
+
+def iter_window_contours(pred_map, pixel_threshold, window_size=4096, overlap=512):
+    """
+    Find the contours of a large probability map in overlapping windows.
+    Each window is a core expanded by overlap. A contour cut by the window border is dropped, it is found complete in
+    a neighbour window. A complete contour is kept only by the window whose core has its bounding rect's top left
+    corner, so contours in the overlap are not duplicated. Contours larger than overlap may be missed.
+    :param pred_map: shape (h,w)
+    :param pixel_threshold: param_pixel_threshold
+    :param window_size: side of a core
+    :param overlap:
+    :return: generator of contours in image coordinates
+    """
+    h, w = pred_map.shape
+    for cy0 in range(0, h, window_size):
+        for cx0 in range(0, w, window_size):
+            cy1 = min(cy0 + window_size, h)
+            cx1 = min(cx0 + window_size, w)
+            wy0, wx0 = max(cy0 - overlap, 0), max(cx0 - overlap, 0)
+            wy1, wx1 = min(cy1 + overlap, h), min(cx1 + overlap, w)
+            thres_mask = np.array(pred_map[wy0:wy1, wx0:wx1] > pixel_threshold, dtype=np.uint8)
+            contours, _ = cv2.findContours(thres_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(wx0, wy0))
+            for contour in contours:
+                x, y, c_w, c_h = cv2.boundingRect(contour)
+                if (x == wx0 and wx0 > 0) or (y == wy0 and wy0 > 0) or \
+                        (x + c_w == wx1 and wx1 < w) or (y + c_h == wy1 and wy1 < h):
+                    continue
+                if cx0 <= x < cx1 and cy0 <= y < cy1:
+                    yield contour
+
+
+def get_pred_path(mosaic_dir, tif_name):
+    if not os.path.exists(mosaic_dir):
+        os.makedirs(mosaic_dir)
+    return os.path.join(mosaic_dir, "{}_pred.npy".format(tif_name))
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from archive import is_member_path, read_member, stat_source, source_exists
+
+# memo of file hashes, keyed by real path, size and mtime, so unchanged files are not hashed again
+file_hash_name = "file_hashes.json"
+
+
+def hash_file(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_source(path):
+    """
+    Hash of a file or an archive member.
+    """
+    if is_member_path(path):
+        return hashlib.sha1(read_member(path)).hexdigest()
+    return hash_file(path)
+
+
+def hash_model(path):
+    """
+    Hash of a model file, or of all files of a SavedModel folder.
+    """
+    if not os.path.isdir(path):
+        return hash_file(path)
+    sha1 = hashlib.sha1()
+    for cur_dir, dirs, files in sorted(os.walk(path)):
+        for file in sorted(files):
+            file_path = os.path.join(cur_dir, file)
+            sha1.update(os.path.relpath(file_path, path).encode())
+            sha1.update(hash_file(file_path).encode())
+    return sha1.hexdigest()
+
+
+def atomic_write(path, write_func):
+    # write to a temp file in the same folder then rename, so other processes never read a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_func(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class PredCache:
+    """
+    Persistent content-addressed cache of prediction maps.
+    The key is the hash of (file content, model file, giantin channel, tiling parameters), so predictions survive
+    restarts, renamed or reordered folders. The cache is bounded by max_size_mb, the least recently used maps are
+    evicted first. Every map is a .npy file, so several processes can share the cache.
+    """
+
+    def __init__(self, cache_dir, max_size_mb, model_hash, params):
+        """
+        :param cache_dir: cache folder
+        :param max_size_mb: max total size of the cached maps
+        :param model_hash: hash_model of the model file
+        :param params: dict of the parameters which change the prediction, e.g. giantin channel and tiling
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.params_hash = hashlib.sha1(json.dumps(dict(params, model=model_hash), sort_keys=True).encode()).hexdigest()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.file_hash_path = os.path.join(cache_dir, file_hash_name)
+        self.file_hashes = {}
+        self.file_hashes_changed = False
+        if os.path.exists(self.file_hash_path):
+            try:
+                with open(self.file_hash_path, "r") as f:
+                    self.file_hashes = json.load(f)
+            except ValueError:
+                # broken memo, files are hashed again
+                self.file_hashes = {}
+
+    def get_file_hash(self, tif_path):
+        real_path, size, mtime_ns = stat_source(tif_path)
+        memo_key = "{}|{}|{}".format(real_path, size, mtime_ns)
+        if memo_key not in self.file_hashes:
+            self.file_hashes[memo_key] = hash_source(real_path)
+            self.file_hashes_changed = True
+        return self.file_hashes[memo_key]
+
+    def get_key(self, tif_path):
+        return hashlib.sha1((self.get_file_hash(tif_path) + self.params_hash).encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, "{}.npy".format(key))
+
+    def load(self, key, mmap=False):
+        """
+        :param key: get_key of the image
+        :param mmap: memory-map the map, for mosaics
+        :return: prediction map, None if not cached
+        """
+        path = self.get_path(key)
+        try:
+            pred = np.load(path, mmap_mode="r" if mmap else None)
+        except (OSError, ValueError):
+            # not cached, or evicted by another process
+            return None
+        # mark as recently used
+        os.utime(path)
+        return pred
+
+    def save(self, key, pred):
+        atomic_write(self.get_path(key), lambda f: np.save(f, pred))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith(".npy"):
+                path = os.path.join(self.cache_dir, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def save_file_hashes(self):
+        if not self.file_hashes_changed:
+            return
+        # drop memo entries of files which do not exist any more
+        self.file_hashes = {key: value for key, value in self.file_hashes.items()
+                            if source_exists(key.split("|")[0])}
+        atomic_write(self.file_hash_path, lambda f: f.write(json.dumps(self.file_hashes).encode()))
+        self.file_hashes_changed = False
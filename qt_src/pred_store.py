@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+
+
+class CompactPred:
+    """
+    Compact in-memory store of a probability map: uint8 codes, and optionally only the bounding-box crops around the
+    thresholded regions (zero elsewhere).
+    The codes are quantized relative to pixel_threshold: probabilities up to the threshold take the codes 0..t and the
+    ones above it t+1..255. So code > t if and only if pred > pixel_threshold, and the dequantized map gives the same
+    thresholded mask, and the same contours, as the float map at that threshold.
+    """
+
+    def __init__(self, pred, pixel_threshold, crop=False, margin=64):
+        """
+        :param pred: probability map, shape (h,w)
+        :param pixel_threshold: param_pixel_threshold
+        :param crop: keep only the crops around thresholded regions
+        :param margin: margin of the crops, at least param_giantin_roi_size so check_contours gets the same crop_pred
+        """
+        pred = np.asarray(pred, dtype=np.float32)
+        self.shape = pred.shape
+        self.pixel_threshold = pixel_threshold
+        # code of pixel_threshold, at least one code is left above it
+        self.threshold_code = min(max(int(round(pixel_threshold * 255)), 0), 254)
+        thres_mask = pred > pixel_threshold
+        codes = self.encode(pred, thres_mask)
+        if not crop:
+            self.crops = [(0, 0, codes)]
+            return
+        dilated = cv2.dilate(thres_mask.astype(np.uint8), np.ones((2 * margin + 1, 2 * margin + 1), np.uint8))
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats(dilated, connectivity=8)
+        # label 0 is background
+        self.crops = [(y, x, codes[y:y + h, x:x + w].copy())
+                      for x, y, w, h, _ in stats[1:num_labels]]
+
+    def encode(self, pred, thres_mask):
+        t = self.threshold_code
+        threshold = np.float64(self.pixel_threshold)
+        pred = np.clip(pred.astype(np.float64), 0, 1)
+        codes = np.zeros(pred.shape, dtype=np.uint8)
+        if t > 0 and threshold > 0:
+            below = np.minimum(pred / threshold, 1)
+            codes[~thres_mask] = np.rint(below[~thres_mask] * t)
+        if thres_mask.any():
+            above = (pred[thres_mask] - threshold) / (1 - threshold) * (255 - t)
+            codes[thres_mask] = t + np.clip(np.rint(above), 1, 255 - t)
+        return codes
+
+    def decode(self, codes):
+        t = self.threshold_code
+        threshold = np.float64(self.pixel_threshold)
+        codes = codes.astype(np.float64)
+        if t > 0:
+            below = codes / t * threshold
+        else:
+            below = np.zeros_like(codes)
+        # the lowest code above t is still more than a quantization step above the threshold
+        above = threshold + (codes - t) / (255 - t) * (1 - threshold)
+        return np.where(codes > t, above, below).astype(np.float32)
+
+    @property
+    def nbytes(self):
+        return sum(codes.nbytes for _, _, codes in self.crops)
+
+    def to_array(self):
+        """
+        :return: dequantized float32 probability map
+        """
+        pred = np.zeros(self.shape, dtype=np.float32)
+        for y, x, codes in self.crops:
+            pred[y:y + codes.shape[0], x:x + codes.shape[1]] = self.decode(codes)
+        return pred
+
+
+def compact_pred(pred, pixel_threshold, crop=False, margin=64):
+    # memory-mapped maps of mosaics are already on disk
+    if isinstance(pred, (np.memmap, CompactPred)):
+        return pred
+    return CompactPred(pred, pixel_threshold, crop=crop, margin=margin)
+
+
+def to_pred_array(pred):
+    """
+    Probability map of pred_data, which can be a CompactPred.
+    """
+    if isinstance(pred, CompactPred):
+        return pred.to_array()
+    return pred
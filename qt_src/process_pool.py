@@ -0,0 +1,201 @@
+import collections
+import logging
+import mmap
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# On Windows a shared memory block is freed when its last handle is closed, so a worker can not hand a block over to
+# the main process after it returns. Results of workers are pickled there.
+share_results = os.name != "nt"
+
+# Progress of a worker process, created by init_worker
+_worker_progress = None
+
+
+def share_groups(groups):
+    """
+    Copy groups of arrays into one shared memory block, so they are not pickled between processes.
+    Memory-mapped files (e.g. mosaics) are passed by file name instead of being copied.
+    :param groups: dict of group name: list of arrays
+    :return: SharedMemory (None if nothing is copied), descriptor for receive_groups
+    """
+    metas = {}
+    size = 0
+    for key, arrays in groups.items():
+        metas[key] = []
+        for array in arrays:
+            if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+                metas[key].append(("memmap", array.filename, array.dtype.str, array.shape, array.offset))
+            else:
+                array = np.asarray(array)
+                metas[key].append(("shm", size, array.dtype.str, array.shape))
+                size += array.nbytes
+    if size == 0:
+        return None, (None, metas)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    for key, arrays in groups.items():
+        for array, meta in zip(arrays, metas[key]):
+            if meta[0] == "shm":
+                np.ndarray(meta[3], dtype=meta[2], buffer=shm.buf, offset=meta[1])[...] = array
+    return shm, (shm.name, metas)
+
+
+def receive_groups(descriptor, unlink=False):
+    """
+    Copy the arrays of share_groups out of shared memory.
+    :param descriptor: descriptor from share_groups
+    :param unlink: free the shared memory block, by the process which owns it
+    :return: dict of group name: list of arrays
+    """
+    name, metas = descriptor
+    shm = shared_memory.SharedMemory(name=name) if name is not None else None
+    groups = {}
+    try:
+        for key, key_metas in metas.items():
+            groups[key] = []
+            for meta in key_metas:
+                if meta[0] == "memmap":
+                    _, filename, dtype, shape, offset = meta
+                    groups[key].append(np.memmap(filename, dtype=dtype, mode="r", shape=shape, offset=offset))
+                else:
+                    _, offset, dtype, shape = meta
+                    groups[key].append(np.array(np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)))
+    finally:
+        if shm is not None:
+            shm.close()
+            if unlink:
+                shm.unlink()
+    return groups
+
+
+def init_worker(progress_kwargs, image_name_list, load_model, intra_op_threads, inter_op_threads):
+    """
+    Initializer of a worker process: limit TF and OpenCV threads, then load the model once.
+    """
+    import tensorflow as tf
+    # must be set before TF runs any op
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    cv2.setNumThreads(intra_op_threads)
+
+    # processing imports this module
+    from processing import Progress
+    from inference import load_inference_model
+    global _worker_progress
+    _worker_progress = Progress(model=None, logger=logging.getLogger(), image_path_list=[], pred_data=None,
+                                golgi_images=None, **progress_kwargs)
+    _worker_progress.image_name_list = image_name_list
+    if load_model:
+        whole_image = _worker_progress.inference_mode == "whole"
+        _worker_progress.model = load_inference_model(backend=_worker_progress.inference_backend,
+                                                      batch_size=_worker_progress.get_batch_size(),
+                                                      num_threads=_worker_progress.inference_threads,
+                                                      fully_convolutional=whole_image)
+
+
+def process_task(task):
+    """
+    Process one image in a worker.
+    :param task: dict of index and tif_path to predict and analyse an image,
+                 or dict of index and shared golgi_image and pred_data to analyse them again.
+    :return: dict of index, no. of skipped patches and cached images, no. of rejected and checked contours, roi coords
+             and the shared arrays
+    """
+    progress = _worker_progress
+    num_skipped_patches = progress.num_skipped_patches
+    num_cached_images = progress.num_cached_images
+    num_rejected = dict(progress.num_rejected)
+    num_checked = progress.num_checked
+    if "tif_path" in task:
+        items = iter([progress.read_image(task["index"], task["tif_path"])])
+        for _, stage_func in progress.get_stages()[1:]:
+            items = stage_func(items)
+        # exhaust the stages, so the cache stage saves its file hashes
+        item, = list(items)
+        groups = {"golgi_image": [item["golgi_image"]], "pred_data": [item["pred_data"]]}
+    else:
+        item = {key: arrays[0] for key, arrays in receive_groups(task["shared"]).items()}
+        groups = {}
+    selected_golgi_list, shifted_golgi_list, giantin_mask_list, giantin_pred_list, roi_coords_list = \
+        progress.analysis_golgi(item["golgi_image"], item["pred_data"])
+    groups.update({"selected_golgi": selected_golgi_list, "shifted_golgi": shifted_golgi_list,
+                   "giantin_mask": giantin_mask_list, "giantin_pred": giantin_pred_list})
+    result = {"index": task["index"], "num_skipped_patches": progress.num_skipped_patches - num_skipped_patches,
+              "num_cached_images": progress.num_cached_images - num_cached_images, "roi_coords": roi_coords_list,
+              "num_rejected": {stage: progress.num_rejected[stage] - num_rejected[stage] for stage in num_rejected},
+              "num_checked": progress.num_checked - num_checked}
+    if share_results:
+        shm, result["shared"] = share_groups(groups)
+        if shm is not None:
+            # the main process unlinks it after copying
+            shm.close()
+    else:
+        result["groups"] = groups
+    return result
+
+
+class ProcessPool:
+    """
+    Process pool which shards images across workers. Each worker loads the model once, and images and results are
+    passed through shared memory. Results are yielded in input order.
+    """
+
+    def __init__(self, progress_kwargs, image_name_list, load_model=True, num_workers=None, intra_op_threads=1,
+                 inter_op_threads=1):
+        """
+        :param progress_kwargs: parameters of Progress in the workers
+        :param image_name_list: image names, for the logs of workers
+        :param load_model: load the model in the workers, False to analyse the predictions of last time
+        :param num_workers: no. of worker processes, None for no. of cores
+        :param intra_op_threads: TF intra-op threads of each worker
+        :param inter_op_threads: TF inter-op threads of each worker
+        """
+        self.num_workers = num_workers or os.cpu_count()
+        # fork is not safe after TF and Qt are initialized
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(self.num_workers, initializer=init_worker,
+                                 initargs=(progress_kwargs, image_name_list, load_model, intra_op_threads,
+                                           inter_op_threads))
+
+    def run(self, tasks):
+        """
+        :param tasks: iterable of tasks of process_task, golgi_image and pred_data of a task are shared by this method.
+        :return: generator of dict of index, no. of skipped patches and groups of result arrays, in input order
+        """
+        # at most 2 tasks per worker are in flight, so shared inputs do not pile up in memory
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                shm = None
+                if "golgi_image" in task:
+                    shm, shared = share_groups({"golgi_image": [task.pop("golgi_image")],
+                                                "pred_data": [task.pop("pred_data")]})
+                    task["shared"] = shared
+                pending.append((shm, self.pool.apply_async(process_task, (task,))))
+                if len(pending) >= 2 * self.num_workers:
+                    yield self.finish(*pending.popleft())
+            while len(pending) > 0:
+                yield self.finish(*pending.popleft())
+        finally:
+            for shm, _ in pending:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+            self.pool.terminate()
+            self.pool.join()
+
+    @staticmethod
+    def finish(shm, async_result):
+        try:
+            result = async_result.get()
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        if "shared" in result:
+            result["groups"] = receive_groups(result.pop("shared"), unlink=True)
+        return result
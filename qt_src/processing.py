@@ -1,17 +1,35 @@
 import logging
+import math
 import os.path
+import tempfile
+import threading
 
 import cv2
 from tifffile import tifffile
 
 from PyQt5.QtCore import QObject, pyqtSignal as Signal
-from keras.models import load_model
 
-from metrics import *
 from image_functions import *
+from archive import archive_sep, is_archive, list_archive_tifs, split_member_path, is_member_path, open_source, \
+    source_name
+from image_source import open_image, release_image
+from inference import model_path, saved_model_path, load_inference_model, get_model_file, ensure_tflite_model
+from local_cache import LocalFileCache
+from manifest import FileManifest
+from mosaic import get_image_shape, open_mosaic, predict_mosaic, iter_window_contours, get_pred_path
+from pred_cache import PredCache, hash_model
+from pred_store import compact_pred, to_pred_array
+from process_pool import ProcessPool
+from stage_memo import StageMemo
+from stage_pipeline import StagePipeline, prefetch_map
 
-# valDice0.7042_valMeanIoU0.5532.h5
-model_path = "./model/model.h5"
+# stages of the early rejection of contours, in order
+rejection_stages = ("area", "edge", "probability", "window")
+# rough peak memory (MB) of one 256x256 patch going through U-Net++ on CPU
+patch_memory_mb = 48
+# size and centroid of shifted golgi
+target_size = 701
+centroid = (350, 350)
 
 
 class Progress(QObject):
@@ -23,7 +41,17 @@ class Progress(QObject):
     def __init__(self, model, logger: logging.Logger, image_path_list,
                  param_pixel_threshold, param_giantin_threshold, param_giantin_area_threshold,
                  param_giantin_roi_size, param_giantin_channel, param_blank_channel, param_giantin_overlap,
-                 pred_data, golgi_images, pred_flag=True):
+                 pred_data, golgi_images, pred_flag=True, inference_memory_budget=1024, pipeline_queue_size=2,
+                 inference_backend="keras", inference_threads=None, inference_mode="patch",
+                 skip_background=True, min_foreground_pixels=1,
+                 coarse_to_fine=False, coarse_downsample=4, coarse_threshold=0.3, coarse_margin=64,
+                 mosaic_min_pixels=10000 * 10000, mosaic_dir=None,
+                 num_workers=0, worker_intra_op_threads=1, worker_inter_op_threads=1,
+                 pred_cache_dir=None, pred_cache_size_mb=4096, analysis_memo=None,
+                 compact_pred=True, compact_pred_crop=False, compact_pred_margin=64, lazy_load=True, read_threads=4,
+                 manifest=None, dedup_by_content=False, preflight=True,
+                 local_cache_dir=None, local_cache_size_mb=20480, subtraction_search="step",
+                 early_reject=True, heuristic_reject=False):
         super().__init__()
         self.logger = logger
         self.image_path_list = image_path_list
@@ -34,8 +62,70 @@ class Progress(QObject):
         self.param_giantin_channel = param_giantin_channel
         self.param_blank_channel = param_blank_channel
         self.param_giantin_overlap = param_giantin_overlap
+        # memory budget (MB) of one inference batch
+        self.inference_memory_budget = inference_memory_budget
+        # max no. of images waiting between two pipeline stages
+        self.pipeline_queue_size = pipeline_queue_size
+        # "keras" or "tflite", and no. of threads of tflite
+        self.inference_backend = inference_backend
+        self.inference_threads = inference_threads
+        # "patch": overlapping 256x256 patches. "whole": fully convolutional prediction of whole image.
+        self.inference_mode = inference_mode
+        # skip the patches without pixels brighter than Otsu threshold of the giantin image
+        self.skip_background = skip_background
+        self.min_foreground_pixels = min_foreground_pixels
+        self.num_skipped_patches = 0
+        # coarse-to-fine detection: locate giantin in a downsampled image first
+        self.coarse_to_fine = coarse_to_fine
+        self.coarse_downsample = coarse_downsample
+        self.coarse_threshold = coarse_threshold
+        self.coarse_margin = coarse_margin
+        # images with more pixels are processed out of core, the probability maps are saved in mosaic_dir
+        self.mosaic_min_pixels = mosaic_min_pixels
+        self.mosaic_dir = mosaic_dir if mosaic_dir is not None else os.path.join(tempfile.gettempdir(),
+                                                                                 "enface_mosaic")
+        # no. of worker processes, 0 to run the pipeline in this process. TF threads of each worker.
+        self.num_workers = num_workers
+        self.worker_intra_op_threads = worker_intra_op_threads
+        self.worker_inter_op_threads = worker_inter_op_threads
+        # persistent cache of prediction maps, disabled if pred_cache_size_mb is 0
+        self.pred_cache_dir = pred_cache_dir if pred_cache_dir is not None else os.path.join(
+            os.path.expanduser("~"), ".enface_pred_cache")
+        self.pred_cache_size_mb = pred_cache_size_mb
+        self.pred_cache = None
+        self.num_cached_images = 0
         self.pred_flag = pred_flag
         self.pred_data = pred_data
+        # memory-map or decode per channel, instead of reading whole images
+        self.lazy_load = lazy_load
+        # no. of threads decoding images ahead of inference, 1 to read one after another
+        self.read_threads = read_threads
+        # FileManifest of the input folders, shared with MainWindow. Remove copies of the same image by content.
+        self.manifest = manifest
+        self.dedup_by_content = dedup_by_content
+        # check the headers of all images before any heavy work
+        self.preflight = preflight
+        # copy inputs to a local folder ahead of reading them, disabled if local_cache_dir is None
+        self.local_cache_dir = local_cache_dir
+        self.local_cache_size_mb = local_cache_size_mb
+        self.local_cache = None
+        # the caches are created lazily by the first of the read threads
+        self.cache_lock = threading.Lock()
+        # keep pred_data as uint8-quantized CompactPred, optionally only the crops around thresholded regions
+        self.compact_pred = compact_pred
+        self.compact_pred_crop = compact_pred_crop
+        self.compact_pred_margin = max(compact_pred_margin, param_giantin_roi_size)
+        # StageMemo of the analysis of pred_data from last time
+        self.analysis_memo = analysis_memo
+        # "step" or "bisect", search of the background subtraction level of each crop
+        self.subtraction_search = subtraction_search
+        # cheap tests of each contour on pred_mask before check_contours, and no. of contours rejected by each
+        self.early_reject = early_reject
+        # also reject by the mean probability inside the predicted contour and by a clipped crop window. These are not
+        # the tests of check_golgi_crop, they can reject contours which it would accept.
+        self.heuristic_reject = heuristic_reject
+        self.num_rejected = dict.fromkeys(rejection_stages, 0)
+        self.num_checked = 0
         self.golgi_images = golgi_images
         self.crop_golgi_list = []
         self.shifted_crop_golgi_list = []
@@ -49,90 +139,392 @@ class Progress(QObject):
         if model is not None:
             self.model = model
         else:
-            if not os.path.exists(model_path):
+            if not os.path.exists(model_path) and not os.path.exists(saved_model_path):
                 raise Exception("No such model file:{}".format(model_path))
 
-    def pipeline(self):
+    def get_manifest(self):
+        if self.manifest is None:
+            self.manifest = FileManifest()
+        return self.manifest
+
+    def check_header(self, tif_path):
+        """
+        Check a TIFF header against the channel params, without decoding pixels.
+        :return: problem message, None if no problem
+        """
         try:
-            if self.pred_flag:
-                # read images
-                tif_name_list = []
-                tif_folder_list = []
-                golgi_image_list = []
-                giantin_image_list = []
-                for path in self.image_path_list:
-                    if os.path.isdir(path):
-                        for curDir, dirs, files in os.walk(path):
-                            for file in files:
-                                if file.endswith(".tif"):
-                                    tif_path = os.path.join(curDir, file)
-                                    tif_folder = os.path.split(tif_path)[0]
-                                    tif_folder_list.append(tif_folder)
-                                    tif_name = os.path.split(tif_path)[1].split(".")[0]
-                                    tif_name_list.append(tif_name)
-                                    golgi_image = tifffile.imread(tif_path)
-                                    golgi_image_list.append(golgi_image)
-                                    giantin_image_list.append(golgi_image[self.param_giantin_channel])
-                    elif path.endswith(".tif"):
-                        golgi_image = tifffile.imread(path)
-                        tif_folder = os.path.split(path)[0]
-                        tif_name = os.path.split(path)[1].split(".")[0]
-                        tif_folder_list.append(tif_folder)
-                        tif_name_list.append(tif_name)
-                        golgi_image_list.append(golgi_image)
-                        giantin_image_list.append(golgi_image[self.param_giantin_channel])
-                # print(tif_path_list)
-                num_golgi_images = len(tif_name_list)
-                self.image_name_list = tif_name_list
-                self.image_folder_list = tif_folder_list
-                self.logger.info("Read {} golgi images sucessfully.".format(num_golgi_images))
-                self.append_text.emit("Read {} golgi images sucessfully.".format(num_golgi_images))
-
-                # preprocessing images to model input
-                padded_giantin_list, patches_giantin_list = padding_image(giantin_image_list, do_patchify=True,
-                                                                          clear_edge_roi=False, patch_size=(256, 256),
-                                                                          patch_step=206)
-                model_input = make_model_input(patches_giantin_list,
-                                               do_norm=True,
-                                               data_shape=(-1, 256, 256, 1))
-                self.logger.info("Preprocess images sucessfully.")
-                self.append_text.emit("Preprocess images sucessfully.")
-
-                # run model
-                if self.model is None:
-                    self.model = load_model(model_path, compile=False)
-                    self.model.compile(loss=bce_dice_loss,
-                                       metrics=["binary_crossentropy", mean_iou, dice_coef])
-                model_pred = []
-                for j, image_ in enumerate(model_input):
-
-                    finished = "==" * (j + 1)
-                    left = ".." * (num_golgi_images - j - 1)
-                    progress_text = "Predicting giantin image: {}/{} [{}>{}] ".format(j + 1, num_golgi_images, finished,
-                                                                                      left)
-                    if j == 0:
-                        self.append_text.emit(progress_text)
-                    else:
-                        self.update_progress.emit(progress_text)
+            header = self.get_manifest().get_header(tif_path)
+        except Exception as e:
+            return "can not read TIFF header: {}".format(e)
+        shape = header["shape"]
+        if len(shape) != 3:
+            return "shape {} is not (channel, height, width).".format(tuple(shape))
+        num_channels = shape[0]
+        if not 0 <= self.param_giantin_channel < num_channels:
+            return "giantin channel {} does not exist, the image has {} channels.".format(
+                self.param_giantin_channel + 1, num_channels)
+        # a negative blank channel (-1 in UI) means no blank channel
+        if self.param_blank_channel >= num_channels:
+            return "blank channel {} does not exist, the image has {} channels.".format(
+                self.param_blank_channel + 1, num_channels)
+        if np.dtype(header["dtype"]).kind not in "uif":
+            return "dtype {} is not supported.".format(header["dtype"])
+        return None
+
+    def preflight_check(self, tif_path_list, max_messages=10):
+        """
+        Check the headers of all images and raise one error listing the problems, before any image is predicted.
+        """
+        problems = []
+        header_problems = prefetch_map(self.check_header, tif_path_list, num_threads=max(self.read_threads, 1),
+                                       read_ahead=4 * max(self.read_threads, 1))
+        for tif_path, problem in zip(tif_path_list, header_problems):
+            if problem is not None:
+                problems.append("{}: {}".format(tif_path, problem))
+        self.get_manifest().save()
+        if len(problems) > 0:
+            for problem in problems:
+                self.logger.error(problem)
+            msg = "\n".join(problems[:max_messages])
+            if len(problems) > max_messages:
+                msg += "\n... and {} more, see the log.".format(len(problems) - max_messages)
+            raise Exception("{}/{} images failed the preflight check:\n{}".format(len(problems),
+                                                                                  len(tif_path_list), msg))
+
+    def get_tif_path_list(self):
+        manifest = self.get_manifest()
+        tif_path_list = []
+        for path in self.image_path_list:
+            if os.path.isdir(path):
+                tif_path_list.extend(manifest.walk_tifs(path))
+            elif is_archive(path):
+                tif_path_list.extend(list_archive_tifs(path))
+            elif path.endswith(".tif"):
+                tif_path_list.append(path)
+        unique_path_list = manifest.remove_duplicates(tif_path_list, by_content=self.dedup_by_content)
+        num_duplicates = len(tif_path_list) - len(unique_path_list)
+        if num_duplicates > 0:
+            self.logger.info("Skip {} duplicate golgi images.".format(num_duplicates))
+            self.append_text.emit("Skip {} duplicate golgi images.".format(num_duplicates))
+        manifest.save()
+        return unique_path_list
 
-                    pred_ = self.model.predict(image_, verbose=1)
-                    model_pred.append(pred_)
+    # Stages of the streaming pipeline. Each item is a dict holding the data of one image.
+    def get_pred_cache(self):
+        with self.cache_lock:
+            if self.pred_cache is None and self.pred_cache_size_mb > 0:
+                self.pred_cache = self.create_pred_cache()
+        return self.pred_cache
 
-                # convert model output to original shape
-                pred_mask, pred_mask_patches = pred_to_mask(model_pred)
-                self.pred_data = unpadding_image(pred_mask, giantin_image_list)
-                self.golgi_images = golgi_image_list
+    def create_pred_cache(self):
+        params = {"giantin_channel": self.param_giantin_channel, "backend": self.inference_backend,
+                  "mode": self.inference_mode, "patch_size": 256, "patch_step": 206,
+                  "skip_background": self.skip_background, "min_foreground_pixels": self.min_foreground_pixels,
+                  "coarse_to_fine": self.coarse_to_fine, "coarse_downsample": self.coarse_downsample,
+                  "coarse_threshold": self.coarse_threshold, "coarse_margin": self.coarse_margin,
+                  "mosaic_min_pixels": self.mosaic_min_pixels}
+        model_hash = hash_model(get_model_file(self.inference_backend,
+                                               fully_convolutional=self.inference_mode == "whole"))
+        return PredCache(self.pred_cache_dir, self.pred_cache_size_mb, model_hash, params)
 
-                self.logger.info("Prediction finished.")
-                self.append_text.emit("Prediction finished.")
+    def get_local_cache(self):
+        with self.cache_lock:
+            if self.local_cache is None:
+                self.local_cache = LocalFileCache(self.local_cache_dir, self.local_cache_size_mb)
+        return self.local_cache
+
+    def prefetch_local(self, tif_paths, window=16):
+        """
+        Copy the next files to the local cache in the background, while the current one is read.
+        """
+        tif_paths = list(tif_paths)
+        local_cache = self.get_local_cache()
+        for i, tif_path in enumerate(tif_paths):
+            # archive members are read from the local copy of their archive
+            local_cache.prefetch([split_member_path(path)[0] for path in tif_paths[i:i + window]])
+            yield tif_path
+
+    @staticmethod
+    def get_image_pixels(tif_path):
+        image_shape = get_image_shape(tif_path)
+        return image_shape[-2] * image_shape[-1]
+
+    def read_image(self, index, tif_path):
+        if self.local_cache_dir:
+            # the network share is only read once
+            archive_path, member = split_member_path(tif_path)
+            tif_path = self.get_local_cache().get(archive_path)
+            if member is not None:
+                tif_path = archive_sep.join((tif_path, member))
+        if is_member_path(tif_path):
+            # archive members are decoded from memory, without extracting them
+            golgi_image = tifffile.imread(open_source(tif_path))
+            item = {"index": index, "golgi_image": golgi_image,
+                    "giantin_image": golgi_image[self.param_giantin_channel]}
+        elif self.get_image_pixels(tif_path) >= self.mosaic_min_pixels:
+            # too large to be read into memory
+            self.logger.info("{}: {} is processed out of core.".format(self.image_name_list[index],
+                                                                       get_image_shape(tif_path)))
+            item = {"index": index, "mosaic": True, "golgi_image": open_mosaic(tif_path)}
+        else:
+            golgi_image = open_image(tif_path) if self.lazy_load else tifffile.imread(tif_path)
+            # only the giantin channel is needed before analysis
+            item = {"index": index, "golgi_image": golgi_image,
+                    "giantin_image": np.asarray(golgi_image[self.param_giantin_channel])}
+        pred_cache = self.get_pred_cache()
+        if pred_cache is not None:
+            item["cache_key"] = pred_cache.get_key(tif_path)
+            pred = pred_cache.load(item["cache_key"], mmap=item.get("mosaic", False))
+            if pred is not None:
+                self.logger.info("{}: load prediction from cache.".format(self.image_name_list[index]))
+                item["pred_data"] = pred
+                item["cached"] = True
+        return item
+
+    def read_stage(self, tif_paths):
+        if self.local_cache_dir:
+            tif_paths = self.prefetch_local(tif_paths, window=4 * max(self.read_threads, 1))
+        if self.read_threads > 1:
+            # tifffile releases the GIL while decompressing, so files are decoded in parallel
+            yield from prefetch_map(lambda args: self.read_image(*args), enumerate(tif_paths),
+                                    num_threads=self.read_threads, read_ahead=2 * self.read_threads)
+            return
+        for i, tif_path in enumerate(tif_paths):
+            yield self.read_image(i, tif_path)
+
+    def preprocess_stage(self, items):
+        for item in items:
+            if item.get("mosaic") or "pred_data" in item:
+                # no patches, the mosaic is predicted tile by tile in predict stage, or the prediction is cached
+                item["model_input"] = np.zeros((0, 256, 256, 1), dtype=np.float32)
+                yield item
+                continue
+            padded_giantin_list, patches_giantin_list = padding_image([item["giantin_image"]], do_patchify=True,
+                                                                      clear_edge_roi=False, patch_size=(256, 256),
+                                                                      patch_step=206)
+            item["patch_grid"] = get_patch_grid(padded_giantin_list[0].shape, patch_size=(256, 256), patch_step=206)
+            patches = patches_giantin_list[0]
+            if self.skip_background:
+                item["patch_keep"] = screen_background_patches(item["giantin_image"], patches,
+                                                               min_foreground_pixels=self.min_foreground_pixels)
+                patches = patches[item["patch_keep"]]
+                num_skipped = len(item["patch_keep"]) - len(patches)
+                self.num_skipped_patches += num_skipped
+                self.logger.info("{}: skip {}/{} background patches.".format(self.image_name_list[item["index"]],
+                                                                            num_skipped, len(item["patch_keep"])))
+            item["model_input"] = make_model_input([patches], do_norm=True, data_shape=(-1, 256, 256, 1))[0]
+            yield item
+
+    def get_batch_size(self):
+        return max(1, int(self.inference_memory_budget // patch_memory_mb))
+
+    def predict_stage(self, items):
+        batch_size = self.get_batch_size()
+        self.logger.info("Predict with batch size {}.".format(batch_size))
+        # items waiting for their prediction, key is the input order of batch_predict
+        waiting_items = {}
+
+        def model_input_iter():
+            for i, item in enumerate(items):
+                waiting_items[i] = item
+                model_input = item.pop("model_input")
+                if self.coarse_to_fine and not item.get("mosaic") and "pred_data" not in item:
+                    # run in this thread, so the model is never used by two threads.
+                    model_input = self.keep_candidate_patches(item, model_input, batch_size)
+                yield model_input
+
+        for i, pred_ in batch_predict(self.model, model_input_iter(), batch_size=batch_size):
+            item = waiting_items.pop(i)
+            if "pred_data" in item:
+                pass
+            elif item.get("mosaic"):
+                item["pred_data"] = self.predict_mosaic_item(item)
+            else:
+                item["model_pred"] = pred_
+            yield item
+
+    def predict_mosaic_item(self, item):
+        pred_path = get_pred_path(self.mosaic_dir, "{:04d}_{}".format(item["index"],
+                                                                      self.image_name_list[item["index"]]))
+        return predict_mosaic(self.model, item["golgi_image"], self.param_giantin_channel, pred_path,
+                              batch_size=self.get_batch_size())
+
+    def keep_candidate_patches(self, item, model_input, batch_size):
+        """
+        Coarse-to-fine: only the patches around giantin found in the downsampled image are predicted
+        in full resolution.
+        :param item: image item, patch_keep is updated
+        :param model_input: model input of the patches kept by patch_keep
+        :param batch_size:
+        :return: model input of the candidate patches
+        """
+        candidate_mask = locate_candidates(self.model, item["giantin_image"], downsample=self.coarse_downsample,
+                                           threshold=self.coarse_threshold, margin=self.coarse_margin,
+                                           batch_size=batch_size)
+        candidate_keep = candidate_patches(candidate_mask)
+        patch_keep = item.get("patch_keep", np.ones(len(candidate_keep), dtype=np.bool_))
+        model_input = model_input[candidate_keep[patch_keep]]
+        item["patch_keep"] = np.logical_and(patch_keep, candidate_keep)
+        self.logger.info("{}: predict {}/{} candidate patches in full resolution.".format(
+            self.image_name_list[item["index"]], len(model_input), len(candidate_keep)))
+        return model_input
+
+    def get_tile_size(self):
+        # a tile has about the same no. of pixels as one batch of patches
+        return int(math.sqrt(self.get_batch_size()) * 256) // 16 * 16
+
+    def predict_whole_stage(self, items):
+        tile_size = self.get_tile_size()
+        self.logger.info("Predict whole images with tile size {}.".format(tile_size))
+        for item in items:
+            if "pred_data" in item:
+                pass
+            elif item.get("mosaic"):
+                item["pred_data"] = self.predict_mosaic_item(item)
+            else:
+                item["pred_data"] = predict_whole_image(self.model, item["giantin_image"], tile_size=tile_size)
+            yield item
+
+    def unpad_stage(self, items):
+        for item in items:
+            if "pred_data" in item:
+                yield item
+                continue
+            # convert model output to original shape
+            keep_list = [item["patch_keep"]] if "patch_keep" in item else None
+            pred_mask, _ = pred_to_mask([item.pop("model_pred")], grid_shape_list=[item["patch_grid"]],
+                                        keep_list=keep_list)
+            item["pred_data"] = unpadding_image(pred_mask, [item["giantin_image"]])[0]
+            yield item
+
+    def cache_stage(self, items):
+        pred_cache = self.get_pred_cache()
+        for item in items:
+            if item.get("cached"):
+                self.num_cached_images += 1
+            elif "cache_key" in item:
+                pred_cache.save(item["cache_key"], item["pred_data"])
+            yield item
+        pred_cache.save_file_hashes()
+
+    def get_stages(self):
+        if self.inference_mode == "whole":
+            stages = [("read", self.read_stage),
+                      ("predict", self.predict_whole_stage)]
+        else:
+            stages = [("read", self.read_stage),
+                      ("preprocess", self.preprocess_stage),
+                      ("predict", self.predict_stage),
+                      ("unpad", self.unpad_stage)]
+        if self.pred_cache_size_mb > 0:
+            stages.append(("cache", self.cache_stage))
+        return stages
+
+    def get_worker_kwargs(self):
+        return {"param_pixel_threshold": self.param_pixel_threshold,
+                "param_giantin_threshold": self.param_giantin_threshold,
+                "param_giantin_area_threshold": self.param_giantin_area_threshold,
+                "param_giantin_roi_size": self.param_giantin_roi_size,
+                "param_giantin_channel": self.param_giantin_channel,
+                "param_blank_channel": self.param_blank_channel,
+                "param_giantin_overlap": self.param_giantin_overlap,
+                "inference_memory_budget": self.inference_memory_budget,
+                "inference_backend": self.inference_backend,
+                "inference_threads": self.inference_threads,
+                "inference_mode": self.inference_mode,
+                "skip_background": self.skip_background,
+                "min_foreground_pixels": self.min_foreground_pixels,
+                "coarse_to_fine": self.coarse_to_fine,
+                "coarse_downsample": self.coarse_downsample,
+                "coarse_threshold": self.coarse_threshold,
+                "coarse_margin": self.coarse_margin,
+                "mosaic_min_pixels": self.mosaic_min_pixels,
+                "mosaic_dir": self.mosaic_dir,
+                "lazy_load": self.lazy_load,
+                "read_threads": 1,
+                "local_cache_dir": self.local_cache_dir,
+                "local_cache_size_mb": self.local_cache_size_mb,
+                "pred_cache_dir": self.pred_cache_dir,
+                "pred_cache_size_mb": self.pred_cache_size_mb,
+                "subtraction_search": self.subtraction_search,
+                "early_reject": self.early_reject,
+                "heuristic_reject": self.heuristic_reject}
+
+    def pool_items(self, tasks):
+        """
+        Shard images across worker processes. Each worker predicts (if pred_flag) and analyses whole images.
+        :param tasks: dicts of index and tif_path, or index, golgi_image and pred_data to analyse them again
+        :return: generator of image items with the analysis results, in input order
+        """
+        if self.pred_flag and self.inference_backend == "tflite" and self.inference_mode != "whole":
+            # converted once here, not by every worker at the same time
+            ensure_tflite_model()
+        process_pool = ProcessPool(self.get_worker_kwargs(), self.image_name_list, load_model=self.pred_flag,
+                                   num_workers=self.num_workers, intra_op_threads=self.worker_intra_op_threads,
+                                   inter_op_threads=self.worker_inter_op_threads)
+        self.logger.info("Process images in {} worker processes.".format(process_pool.num_workers))
+        for result in process_pool.run(tasks):
+            groups = result["groups"]
+            self.num_skipped_patches += result["num_skipped_patches"]
+            self.num_cached_images += result["num_cached_images"]
+            for stage, num_rejected in result["num_rejected"].items():
+                self.num_rejected[stage] += num_rejected
+            self.num_checked += result["num_checked"]
+            item = {"analysis": (groups["selected_golgi"], groups["shifted_golgi"], groups["giantin_mask"],
+                                 groups["giantin_pred"], result["roi_coords"])}
+            if "golgi_image" in groups:
+                item["golgi_image"] = groups["golgi_image"][0]
+                item["pred_data"] = groups["pred_data"][0]
+            yield item
+
+    def pipeline(self):
+        try:
+            if self.pred_flag:
+                tif_path_list = self.get_tif_path_list()
+                num_golgi_images = len(tif_path_list)
+                # the folder of an archive member is the folder of its archive
+                self.image_folder_list = [os.path.split(split_member_path(tif_path)[0])[0]
+                                          for tif_path in tif_path_list]
+                self.image_name_list = [source_name(tif_path).split(".")[0] for tif_path in tif_path_list]
+                self.logger.info("Found {} golgi images.".format(num_golgi_images))
+                self.append_text.emit("Found {} golgi images.".format(num_golgi_images))
+                if self.preflight:
+                    self.preflight_check(tif_path_list)
+
+                if self.num_workers > 0:
+                    # workers load their own model
+                    image_items = self.pool_items({"index": i, "tif_path": tif_path}
+                                                  for i, tif_path in enumerate(tif_path_list))
+                else:
+                    if self.model is None:
+                        # inference only, no need to compile. Warm up with the batch size used in predict_stage.
+                        self.model = load_inference_model(backend=self.inference_backend,
+                                                          batch_size=self.get_batch_size(),
+                                                          num_threads=self.inference_threads,
+                                                          fully_convolutional=self.inference_mode == "whole")
+                    # read -> preprocess -> predict -> unpad run in their own threads, analysis runs in this thread.
+                    stage_pipeline = StagePipeline(self.get_stages(), queue_size=self.pipeline_queue_size)
+                    image_items = stage_pipeline.run(tif_path_list)
+                self.pred_data = []
+                self.golgi_images = []
+                # memoized analysis belongs to the images of last time
+                self.analysis_memo = StageMemo()
             else:
                 self.logger.info("Reuse the data from last time.")
                 self.append_text.emit("Reuse the data from last time.")
+                if self.analysis_memo is None:
+                    self.analysis_memo = StageMemo()
+                self.analysis_memo.reset_stats()
+                image_items = ({"golgi_image": golgi_image, "pred_data": pred_mask}
+                               for golgi_image, pred_mask in zip(self.golgi_images, self.pred_data))
+                if self.num_workers > 0:
+                    image_items = self.pool_items(dict(item, index=i, pred_data=to_pred_array(item["pred_data"]))
+                                                  for i, item in enumerate(image_items))
 
             # analysis golgi
             self.logger.info("Analyzing predicted giantin masks.")
-            num_pred_data = len(self.pred_data)
-            for i, pred_mask in enumerate(self.pred_data):
+            num_pred_data = len(self.image_name_list) if self.pred_flag else len(self.pred_data)
+            for i, item in enumerate(image_items):
                 finished = "==" * (i + 1)
                 left = ".." * (num_pred_data - i - 1)
                 progress_text = "Analyzing predicted giantin masks: {}/{} [{}>{}] ".format(i + 1, num_pred_data,
@@ -142,9 +534,24 @@ class Progress(QObject):
                     self.append_text.emit(progress_text)
                 else:
                     self.update_progress.emit(progress_text)
-                selected_golgi_list, shifted_golgi_list, giantin_mask_list, giantin_pred_list, roi_coords_list = self.analysis_golgi(
-                    self.golgi_images[i],
-                    pred_mask)
+                if self.pred_flag:
+                    self.golgi_images.append(item["golgi_image"])
+                    if self.compact_pred:
+                        self.pred_data.append(compact_pred(item["pred_data"], self.param_pixel_threshold,
+                                                           crop=self.compact_pred_crop,
+                                                           margin=self.compact_pred_margin))
+                    else:
+                        self.pred_data.append(item["pred_data"])
+                if "analysis" in item:
+                    # analysed by a worker process
+                    selected_golgi_list, shifted_golgi_list, giantin_mask_list, giantin_pred_list, roi_coords_list = \
+                        item["analysis"]
+                else:
+                    selected_golgi_list, shifted_golgi_list, giantin_mask_list, giantin_pred_list, roi_coords_list = \
+                        self.analysis_golgi(item["golgi_image"], to_pred_array(item["pred_data"]), image_key=i)
+                if "golgi_image" in item:
+                    # a re-analysis in worker processes does not send the image back
+                    release_image(item["golgi_image"])
                 # crop golgi original image
                 self.crop_golgi_list.append(selected_golgi_list)
                 # shifted and resized crop golgi image
@@ -156,8 +563,21 @@ class Progress(QObject):
                 # roi coords
                 self.ministack_roi_list.append(roi_coords_list)
 
+            if self.local_cache is not None:
+                self.local_cache.close()
             self.logger.info("Analyzing predicted giantin masks finished.")
+            for stage, num_reused, num_computed in self.analysis_memo.get_stats():
+                self.logger.info("{} stage: reused {}, computed {}.".format(stage, num_reused, num_computed))
+            rejected_text = "Early rejection of contours: {}. {} contours fully checked.".format(
+                ", ".join("{} {}".format(stage, self.num_rejected[stage]) for stage in rejection_stages),
+                self.num_checked)
+            self.logger.info(rejected_text)
+            self.append_text.emit(rejected_text)
             self.append_text.emit("Analyzing predicted giantin masks finished.")
+            if self.num_skipped_patches > 0:
+                self.append_text.emit("Skipped {} background patches.".format(self.num_skipped_patches))
+            if self.num_cached_images > 0:
+                self.append_text.emit("Loaded {} predictions from cache.".format(self.num_cached_images))
 
         except Exception as e:
             self.logger.error("Error: {}".format(e), exc_info=True)
@@ -167,68 +587,174 @@ class Progress(QObject):
         else:
             self.pipeline_finished.emit(0)
 
-    def analysis_golgi(self, golgi_image, pred_mask):
-        golgi_image = golgi_image.transpose((1, 2, 0))
+    def memoize(self, stage, params, item_key, func):
+        # image_key is None when the data is not kept between runs, e.g. compare_ministacks
+        if self.analysis_memo is None or item_key[0] is None:
+            return func()
+        return self.analysis_memo.get(stage, params, item_key, func)
+
+    def find_contours(self, pred_mask):
+        """
+        :return: contours of the candidates, no. of candidates rejected by area and by edge before tracing them
+        """
+        if isinstance(pred_mask, np.memmap):
+            # out of core mosaic, only crops of golgi_image and pred_mask are read into memory
+            return list(iter_window_contours(pred_mask, self.param_pixel_threshold)), 0, 0
         thres_mask = np.array(pred_mask > self.param_pixel_threshold, dtype=np.uint8)
-        contours, _ = cv2.findContours(thres_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        target_size = 701
-        centroid = (350, 350)
+        return find_candidates(thres_mask, min_area=0.5 * self.param_giantin_area_threshold,
+                               clear_edge=self.early_reject)
+
+    def screen_contour(self, golgi_shape, pred_mask, contour):
+        """
+        Cascade of cheap tests on a contour of pred_mask, before its crop is copied and subtracted: area and bounding box
+        in the edge, which check_contours would reject anyway. With heuristic_reject, also the mean probability inside
+        the contour and the crop window.
+        :param golgi_shape: (h,w,c)
+        :return: the stage rejecting the contour, None if it passes all of them
+        """
+        if cv2.contourArea(contour) < 0.5 * self.param_giantin_area_threshold:
+            return "area"
+        if not self.early_reject:
+            return None
+        golgi_h, golgi_w = golgi_shape[:2]
+        contour_rect = cv2.boundingRect(contour)
+        x, y, w, h = contour_rect
+        # the same test as check_contours
+        if x == 0 or y == 0 or x + w == golgi_w - 1 or y + h == golgi_h - 1:
+            return "edge"
+        if not self.heuristic_reject:
+            return None
+        contour_mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(contour_mask, [contour], 0, 1, -1, offset=(-x, -y))
+        # check_golgi_crop tests the giantin contour instead, which can be a subset with a higher mean
+        if np.asarray(pred_mask[y:y + h, x:x + w])[contour_mask > 0].mean() < self.param_giantin_threshold:
+            return "probability"
+        roi_coord, _ = get_crop_window(contour_rect, golgi_w, golgi_h, rect_size=self.param_giantin_roi_size)
+        # the window is clipped at the right or bottom corner and cuts the giantin, check_golgi_crop may still
+        # subtract the background until the giantin is inside
+        if not window_contains(roi_coord, contour_rect):
+            return "window"
+        return None
+
+    def check_golgi(self, golgi_image, pred_mask, contour):
+        """
+        Per-contour check, the roi is shrunk once if it is larger than needed by the gyradius.
+        :return: crop_golgi, giantin_mask, crop_pred, roi_coord, gyradius. None if rejected.
+        """
+        sub_list = None
+        rect_size = self.param_giantin_roi_size
+        for _ in range(2):
+            crop_golgi, giantin_contour, crop_pred, giantin_mask, flag, sub_list, rej_msg, roi_coord = check_contours(
+                golgi_image,
+                pred_mask, contour,
+                giantin_channel=self.param_giantin_channel,
+                blank_channel=self.param_blank_channel,
+                min_giantin_area=self.param_giantin_area_threshold,
+                sub_list=sub_list,
+                giantin_possibility_threshold=self.param_giantin_threshold,
+                rect_size=rect_size,
+                show_plt=False,
+                overlapping=self.param_giantin_overlap,
+                level_search=self.subtraction_search)
+            if flag:
+                crop_giantin = crop_golgi[:, :, self.param_giantin_channel]
+                mx, my = cal_center_of_mass(crop_giantin, giantin_contour)
+                gyradius = cal_gyradius(crop_giantin, mx, my)
+                if rect_size > gyradius * target_size / 100:
+                    rect_size = int(gyradius * target_size / 100)
+                    # print("new rect_size: {}".format(rect_size))
+                    continue
+                return crop_golgi, giantin_mask, crop_pred, roi_coord, gyradius
+            else:
+                self.logger.info(rej_msg)
+                return None
+        return None
+
+    def shift_golgi(self, crop_golgi, gyradius):
+        """
+        Resize by the gyradius, normalize the total intensity and shift the giantin center of mass to the centroid.
+        :return: shifted golgi, None if it can not be shifted.
+        """
+        new_size = [int(size * 100 / gyradius) for size in crop_golgi.shape[:2]]
+        resized_golgi = cv2.resize(crop_golgi, new_size, interpolation=cv2.INTER_LINEAR)
+        normalized_golgi = normalize_total_intensity(resized_golgi, target_total_intensity=200000000)
+        return shift_make_border(normalized_golgi, giantin_channel=self.param_giantin_channel,
+                                 border_size=(target_size, target_size),
+                                 center_coord=centroid, shift_to_imageJ=True)
+
+    def analysis_golgi(self, golgi_image, pred_mask, image_key=None):
+        """
+        Stages: contour extraction -> per-contour check -> resize/normalize/shift. If image_key is given, the output of
+        each stage is memoized by the parameters it depends on.
+        :param golgi_image: shape (c,h,w)
+        :param pred_mask: predicted probability map
+        :param image_key: key of the image in analysis_memo, e.g. its index
+        """
+        golgi_image = golgi_image.transpose((1, 2, 0))
+        contours, num_small, num_edge = self.memoize("contours", (self.param_pixel_threshold,
+                                                                  self.param_giantin_area_threshold,
+                                                                  self.early_reject), (image_key,),
+                                                     lambda: self.find_contours(pred_mask))
+        # find_candidates runs the area and edge tests of screen_contour in the same order, so the counts are the same
+        self.num_rejected["area"] += num_small
+        self.num_rejected["edge"] += num_edge
+        check_params = (self.param_giantin_channel, self.param_blank_channel, self.param_giantin_area_threshold,
+                        self.param_giantin_threshold, self.param_giantin_roi_size, self.param_giantin_overlap,
+                        self.subtraction_search)
         selected_golgi_list = []
         shifted_golgi_list = []
         giantin_mask_list = []
         giantin_pred_list = []
         roi_coord_list = []
         for i, contour in enumerate(contours):
-            contour_area = cv2.contourArea(contour)
             # The reason of duplicate giantin: not full parts are predicted. After thresholding, it splited.
             # Before, didn't control min area of contour area.
-            if contour_area < 0.5 * self.param_giantin_area_threshold:
+            rejected_stage = self.screen_contour(golgi_image.shape, pred_mask, contour)
+            if rejected_stage is not None:
+                self.num_rejected[rejected_stage] += 1
                 continue
-            sub_list = None
-            rect_size = self.param_giantin_roi_size
-            for _ in range(2):
-                crop_golgi, giantin_contour, crop_pred, giantin_mask, flag, sub_list, rej_msg, roi_coord = check_contours(
-                    golgi_image,
-                    pred_mask, contour,
-                    giantin_channel=self.param_giantin_channel,
-                    blank_channel=self.param_blank_channel,
-                    min_giantin_area=self.param_giantin_area_threshold,
-                    sub_list=sub_list,
-                    giantin_possibility_threshold=self.param_giantin_threshold,
-                    rect_size=rect_size,
-                    show_plt=False,
-                    overlapping=self.param_giantin_overlap)
-                if flag:
-                    crop_giantin = crop_golgi[:, :, self.param_giantin_channel]
-                    mx, my = cal_center_of_mass(crop_giantin, giantin_contour)
-                    gyradius = cal_gyradius(crop_giantin, mx, my)
-                    if rect_size > gyradius * target_size / 100:
-                        rect_size = int(gyradius * target_size / 100)
-                        # print("new rect_size: {}".format(rect_size))
-                        continue
-                    else:
-                        new_size = [int(size * 100 / gyradius) for size in crop_giantin.shape]
-                        resized_golgi = cv2.resize(crop_golgi, new_size, interpolation=cv2.INTER_LINEAR)
-                        normalized_golgi = normalize_total_intensity(resized_golgi, target_total_intensity=200000000)
-                        shifted_golgi = shift_make_border(normalized_golgi, giantin_channel=self.param_giantin_channel,
-                                                          border_size=(target_size, target_size),
-                                                          center_coord=centroid, shift_to_imageJ=True)
-                        if shifted_golgi is None:
-                            break
-                        selected_golgi_list.append(crop_golgi)
-                        shifted_golgi_list.append(shifted_golgi)
-                        giantin_mask_list.append(giantin_mask)
-                        giantin_pred_list.append(crop_pred)
-                        roi_coord_list.append(roi_coord)
-                        break
-                else:
-                    self.logger.info(rej_msg)
-                    break
+            self.num_checked += 1
+            # the same contour is found again by another pixel threshold
+            contour_key = (image_key, contour.tobytes())
+            checked = self.memoize("check", check_params, contour_key,
+                                   lambda: self.check_golgi(golgi_image, pred_mask, contour))
+            if checked is None:
+                continue
+            crop_golgi, giantin_mask, crop_pred, roi_coord, gyradius = checked
+            # only depends on the output of check, evicted with it
+            shifted_golgi = self.memoize("shift", check_params, contour_key,
+                                         lambda: self.shift_golgi(crop_golgi, gyradius))
+            if shifted_golgi is None:
+                continue
+            selected_golgi_list.append(crop_golgi)
+            shifted_golgi_list.append(shifted_golgi)
+            giantin_mask_list.append(giantin_mask)
+            giantin_pred_list.append(crop_pred)
+            roi_coord_list.append(roi_coord)
         return selected_golgi_list, shifted_golgi_list, giantin_mask_list, giantin_pred_list, roi_coord_list
 
+    def compare_ministacks(self, golgi_image_list, reference_pred_list, test_pred_list):
+        """
+        Compare the accepted mini-stacks of two sets of predictions, e.g. float and quantized model.
+        :return: no. of accepted mini-stacks of reference and test, no. of mini-stacks only accepted by one of them
+        """
+        num_reference = 0
+        num_test = 0
+        num_changed = 0
+        for golgi_image, reference_pred, test_pred in zip(golgi_image_list, reference_pred_list, test_pred_list):
+            reference_roi = {tuple(roi) for roi in self.analysis_golgi(golgi_image, reference_pred)[-1]}
+            test_roi = {tuple(roi) for roi in self.analysis_golgi(golgi_image, test_pred)[-1]}
+            num_reference += len(reference_roi)
+            num_test += len(test_roi)
+            num_changed += len(reference_roi ^ test_roi)
+        return num_reference, num_test, num_changed
+
     def get_model(self):
         return self.model
 
+    def get_analysis_memo(self):
+        return self.analysis_memo
+
     def get_pred_data(self):
         return self.pred_data
 
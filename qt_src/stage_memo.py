@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+
+class StageMemo:
+    """
+    Memo of the outputs of analysis stages, keyed by the parameters each stage depends on.
+    When a parameter is changed, only the stages which depend on it are computed again, e.g. a new
+    param_giantin_roi_size reuses the contours of every image.
+    """
+
+    def __init__(self, max_param_sets=2):
+        """
+        :param max_param_sets: no. of parameter sets kept per stage, the least recently used one is dropped first
+        """
+        self.max_param_sets = max_param_sets
+        # stage name: OrderedDict of params: dict of item key: output
+        self.memo = {}
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, stage, params, item_key, func):
+        """
+        :param stage: stage name
+        :param params: hashable parameters the stage depends on
+        :param item_key: hashable key of the input, e.g. (image index, contour)
+        :param func: computes the output if it is not memoized
+        :return: output of the stage
+        """
+        stage_memo = self.memo.setdefault(stage, OrderedDict())
+        if params not in stage_memo:
+            stage_memo[params] = {}
+            while len(stage_memo) > self.max_param_sets:
+                stage_memo.popitem(last=False)
+        stage_memo.move_to_end(params)
+        outputs = stage_memo[params]
+        if item_key in outputs:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+        else:
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+            outputs[item_key] = func()
+        return outputs[item_key]
+
+    def reset_stats(self):
+        self.hits = {}
+        self.misses = {}
+
+    def get_stats(self):
+        """
+        :return: list of (stage, no. of reused outputs, no. of computed outputs)
+        """
+        return [(stage, self.hits.get(stage, 0), self.misses.get(stage, 0)) for stage in self.memo]
@@ -0,0 +1,117 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# marks the end of a stage's output
+_end = object()
+
+
+class PipelineStageError(Exception):
+    pass
+
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+class StagePipeline:
+    """
+    Producer/consumer engine. Every stage runs in its own thread, and stages are connected by bounded queues,
+    so disk I/O, model inference and analysis overlap while memory is bounded by the queue sizes.
+    A stage is a function which takes an iterator of items and yields items. It can be 1-to-1, a filter,
+    or it can gather several items before yielding (e.g. batched inference).
+    """
+
+    def __init__(self, stages, queue_size=2):
+        """
+        :param stages: list of (stage name, stage function)
+        :param queue_size: max no. of items waiting between two stages
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def _put(self, out_queue, item):
+        while not self.stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _iter_queue(self, in_queue):
+        while not self.stop_event.is_set():
+            try:
+                item = in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _end:
+                return
+            if isinstance(item, _StageError):
+                # pass the error down to the consumer
+                raise item.error
+            yield item
+
+    def _worker(self, name, stage_func, in_items, out_queue):
+        try:
+            for item in stage_func(in_items):
+                if not self._put(out_queue, item):
+                    return
+        except PipelineStageError as e:
+            self._put(out_queue, _StageError(e))
+            return
+        except Exception as e:
+            error = PipelineStageError("Error in {} stage: {}".format(name, e))
+            error.__cause__ = e
+            self._put(out_queue, _StageError(error))
+            return
+        self._put(out_queue, _end)
+
+    def run(self, items):
+        """
+        Start all stages and yield the output of the last stage in order.
+        :param items: iterable of input items of the first stage
+        :return: generator
+        """
+        in_items = iter(items)
+        for name, stage_func in self.stages:
+            out_queue = queue.Queue(maxsize=self.queue_size)
+            thread = threading.Thread(target=self._worker, args=(name, stage_func, in_items, out_queue),
+                                      name="stage-{}".format(name), daemon=True)
+            self.threads.append(thread)
+            in_items = self._iter_queue(out_queue)
+        for thread in self.threads:
+            thread.start()
+        try:
+            yield from in_items
+        finally:
+            self.stop_event.set()
+
+
+def prefetch_map(func, items, num_threads=4, read_ahead=8):
+    """
+    Apply func to items on a thread pool, e.g. to decode several files at once. At most read_ahead items are
+    processed ahead of the consumer.
+    :param func: function of one item, it should release the GIL (e.g. I/O, decompression)
+    :param items: iterable of items
+    :param num_threads: no. of threads
+    :param read_ahead: max no. of items in flight
+    :return: generator of func(item), in input order
+    """
+    futures = deque()
+    executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="prefetch")
+    try:
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= read_ahead:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,42 @@
+import tarfile
+import zipfile
+
+from archive import archive_sep, list_archive_tifs, read_member, source_name
+
+
+def make_zip(tmp_path, members):
+    archive_path = str(tmp_path / "exp.zip")
+    with zipfile.ZipFile(archive_path, "w") as zf:
+        for member in members:
+            zf.writestr(member, member.encode())
+    return archive_path
+
+
+def test_root_members_have_their_own_names(tmp_path):
+    archive_path = make_zip(tmp_path, ["a-giantin.tif", "b-giantin.tif", "notes.txt"])
+    tif_paths = list_archive_tifs(archive_path)
+    assert tif_paths == [archive_path + archive_sep + "a-giantin.tif", archive_path + archive_sep + "b-giantin.tif"]
+    # the image names of Progress.pipeline
+    assert [source_name(tif_path).split(".")[0] for tif_path in tif_paths] == ["a-giantin", "b-giantin"]
+    assert read_member(tif_paths[1]) == b"b-giantin.tif"
+
+
+def test_sub_folder_members(tmp_path):
+    archive_path = make_zip(tmp_path, ["cell1/a_giantin.tif", "cell2/b_giantin.tif"])
+    assert [source_name(tif_path) for tif_path in list_archive_tifs(archive_path)] == ["a_giantin.tif",
+                                                                                       "b_giantin.tif"]
+
+
+def test_tar_members(tmp_path):
+    src = tmp_path / "a-giantin.tif"
+    src.write_bytes(b"tif")
+    archive_path = str(tmp_path / "exp.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as tf:
+        tf.add(str(src), arcname="a-giantin.tif")
+    tif_path, = list_archive_tifs(archive_path)
+    assert source_name(tif_path) == "a-giantin.tif"
+    assert read_member(tif_path) == b"tif"
+
+
+def test_plain_files(tmp_path):
+    assert source_name(str(tmp_path / "a-giantin.tif")) == "a-giantin.tif"
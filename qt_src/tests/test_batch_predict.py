@@ -0,0 +1,61 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from image_functions import batch_predict
+
+
+class StubModel:
+    def __init__(self):
+        self.num_calls = 0
+
+    def predict_on_batch(self, batch):
+        self.num_calls += 1
+        return batch * 2
+
+
+def make_input(n, value):
+    return np.full((n, 4, 4, 1), value, dtype=np.float32)
+
+
+def test_batch_predict_matches_per_image():
+    sizes = [3, 0, 5, 0, 0, 7, 1]
+    inputs = [make_input(n, i) for i, n in enumerate(sizes)]
+    model = StubModel()
+    results = list(batch_predict(model, iter(inputs), batch_size=4))
+    assert [index for index, _ in results] == list(range(len(sizes)))
+    for (_, pred), model_input in zip(results, inputs):
+        np.testing.assert_array_equal(pred, model_input * 2)
+    assert model.num_calls == -(-sum(sizes) // 4)
+
+
+def test_batch_predict_yields_zero_patch_items_without_waiting():
+    consumed = []
+
+    def model_input_iter():
+        for i in range(5):
+            consumed.append(i)
+            yield make_input(0, i)
+
+    predictions = batch_predict(StubModel(), model_input_iter(), batch_size=32)
+    for i in range(5):
+        index, pred = next(predictions)
+        # a fully cached rerun gets each image before the next one is read
+        assert index == i and consumed == list(range(i + 1))
+        assert len(pred) == 0
+
+
+def test_batch_predict_keeps_order_behind_partial_batch():
+    consumed = []
+
+    def model_input_iter():
+        for i, n in enumerate([2, 0, 0]):
+            consumed.append(i)
+            yield make_input(n, i)
+
+    predictions = batch_predict(StubModel(), model_input_iter(), batch_size=4)
+    # image 0 waits for its batch, the cached images behind it wait for image 0
+    assert next(predictions)[0] == 0
+    assert consumed == [0, 1, 2]
+    assert [index for index, _ in predictions] == [1, 2]
@@ -0,0 +1,111 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+import image_functions
+from image_functions import check_golgi_crop, intensity_mask, subtract_background
+
+
+def baseline_subtract_background(task_img, sub):
+    # the per-pixel loop check_golgi_crop used before subtract_background
+    h, w = task_img.shape
+    for i in range(h):
+        for j in range(w):
+            if task_img[i][j] > sub:
+                task_img[i][j] = task_img[i][j] - sub
+            else:
+                task_img[i][j] = 0
+
+
+def baseline_intensity_mask(task_img):
+    channel_mask = task_img / (task_img + 1) * 255
+    return channel_mask.astype(np.uint8)
+
+
+scales = {np.uint8: 200, np.uint16: 60000, np.float32: 1000., np.float64: 1000.}
+
+
+def make_crop(seed, dtype, size=60):
+    """
+    Giantin ring and a blob in the other channel on a noisy background, and the prediction of the ring.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    cy, cx = size / 2 + rng.uniform(-3, 3, 2)
+    r = np.hypot(yy - cy, xx - cx)
+    radius = rng.uniform(8, 14)
+    ring = np.exp(-(r - radius) ** 2 / rng.uniform(4, 12))
+    blob = np.exp(-r ** 2 / (2 * radius ** 2))
+    giantin = (ring + rng.uniform(0, rng.uniform(0.05, 0.4), (size, size))) * scales[dtype]
+    other = (blob + rng.uniform(0, rng.uniform(0.05, 0.4), (size, size))) * scales[dtype]
+    crop = np.stack([giantin, other])
+    if dtype == np.uint16:
+        # saturated pixels
+        crop[0, ring > 0.9] = 65535
+    crop = np.clip(crop, 0, np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else None).astype(dtype)
+    pred = np.clip(ring * rng.uniform(0.8, 1.3), 0, 1).astype(np.float32)
+    # (h,w,c) view of the (c,h,w) image, copied like check_contours does
+    return np.copy(crop.transpose((1, 2, 0))), pred
+
+
+crop_cases = [(seed, dtype) for dtype in scales for seed in range(8)]
+
+
+@pytest.mark.parametrize("dtype", list(scales))
+def test_subtract_background(dtype):
+    rng = np.random.default_rng(0)
+    image = (rng.uniform(0, 1, (40, 40)) * scales[dtype]).astype(dtype)
+    if dtype == np.uint16:
+        image[0, :5] = 65535
+    positive = image[image > 0]
+    for sub in (50, np.float64(positive.min()), np.float64(np.median(positive)), 0.5):
+        expected = np.copy(image)
+        baseline_subtract_background(expected, sub)
+        result = np.copy(image)
+        subtract_background(result, sub)
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("dtype", list(scales))
+def test_intensity_mask(dtype):
+    rng = np.random.default_rng(1)
+    image = (rng.uniform(0, 1, (40, 40)) * scales[dtype]).astype(dtype)
+    image[0, 0] = 0
+    if dtype == np.uint16:
+        image[0, 1:5] = 65535
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.testing.assert_array_equal(intensity_mask(image), baseline_intensity_mask(image))
+
+
+def run_check(crop, pred):
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        return check_golgi_crop(np.copy(crop), pred, [0, 0, 0, 0], giantin_channel=0)
+
+
+@pytest.mark.parametrize("seed,dtype", crop_cases)
+def test_check_golgi_crop_matches_baseline(monkeypatch, seed, dtype):
+    crop, pred = make_crop(seed, dtype)
+    result = run_check(crop, pred)
+    with monkeypatch.context() as m:
+        m.setattr(image_functions, "subtract_background", baseline_subtract_background)
+        m.setattr(image_functions, "intensity_mask", baseline_intensity_mask)
+        expected = run_check(crop, pred)
+    golgi, _, contour, flag, sub_list, reject_msg = result
+    expected_golgi, _, expected_contour, expected_flag, expected_sub_list, expected_reject_msg = expected
+    assert flag == expected_flag
+    assert reject_msg == expected_reject_msg
+    assert sub_list == expected_sub_list
+    np.testing.assert_array_equal(golgi, expected_golgi)
+    if flag:
+        np.testing.assert_array_equal(contour, expected_contour)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_check_golgi_crop_channel_last(seed):
+    crop, pred = make_crop(seed, np.uint16)
+    expected = run_check(crop, pred)
+    result = run_check(np.ascontiguousarray(crop), pred)
+    assert result[3:] == expected[3:]
+    np.testing.assert_array_equal(result[0], expected[0])
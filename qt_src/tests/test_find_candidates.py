@@ -0,0 +1,73 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from image_functions import find_candidates
+
+
+def screen(contours, img_shape, min_area, clear_edge):
+    """
+    cv2.findContours contours through the area and edge tests of Progress.screen_contour.
+    """
+    img_h, img_w = img_shape
+    kept, num_small, num_edge = [], 0, 0
+    for contour in contours:
+        if cv2.contourArea(contour) < min_area:
+            num_small += 1
+            continue
+        x, y, w, h = cv2.boundingRect(contour)
+        if clear_edge and (x == 0 or y == 0 or x + w == img_w - 1 or y + h == img_h - 1):
+            num_edge += 1
+            continue
+        kept.append(contour)
+    return kept, num_small, num_edge
+
+
+def make_mask(seed, size=200):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(25):
+        center = tuple(int(v) for v in rng.integers(0, size, 2))
+        radius = int(rng.integers(1, 20))
+        # filled blobs and 1 px rings, whose contour area is much larger than their no. of pixels
+        cv2.circle(mask, center, radius, 1, -1 if rng.random() < 0.5 else 1)
+    # a component in the hole of a ring
+    cv2.circle(mask, (100, 100), 30, 1, 1)
+    cv2.circle(mask, (100, 100), 5, 1, -1)
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("clear_edge", [False, True])
+@pytest.mark.parametrize("min_area", [0, 50, 250])
+def test_find_candidates_matches_find_contours(seed, clear_edge, min_area):
+    mask = make_mask(seed)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    expected = screen(contours, mask.shape, min_area, clear_edge)[0]
+    result = find_candidates(mask, min_area=min_area, clear_edge=clear_edge)[0]
+    assert len(result) == len(expected)
+    for contour, expected_contour in zip(result, expected):
+        np.testing.assert_array_equal(contour, expected_contour)
+
+
+def test_find_candidates_keeps_thin_ring():
+    mask = np.zeros((40, 40), dtype=np.uint8)
+    cv2.circle(mask, (20, 20), 10, 1, 1)
+    contours, num_small, _ = find_candidates(mask, min_area=200)
+    assert np.count_nonzero(mask) < 200
+    assert len(contours) == 1 and num_small == 0
+    assert cv2.contourArea(contours[0]) >= 200
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("clear_edge", [False, True])
+@pytest.mark.parametrize("min_area", [0, 50, 250])
+def test_find_candidates_rejection_counts(seed, clear_edge, min_area):
+    # analysis_golgi adds these counts to num_rejected, they must be what screen_contour would have rejected
+    mask = make_mask(seed)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    kept, num_small, num_edge = screen(contours, mask.shape, min_area, clear_edge)
+    result, result_small, result_edge = find_candidates(mask, min_area=min_area, clear_edge=clear_edge)
+    assert (result_small, result_edge) == (num_small, num_edge)
+    assert len(result) + result_small + result_edge == len(contours)
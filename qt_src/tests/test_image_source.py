@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+tifffile = pytest.importorskip("tifffile")
+
+from image_functions import check_contours
+from image_source import LazyImage, open_image
+
+
+def make_image(size=120):
+    """
+    Giantin ring in channel 0 and a blob in channel 1, shape (c,h,w), and the prediction of the ring.
+    """
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:size, :size]
+    r = np.hypot(yy - size / 2, xx - size / 2)
+    ring = np.exp(-(r - 12) ** 2 / 8)
+    blob = np.exp(-r ** 2 / (2 * 12 ** 2))
+    image = np.stack([ring + rng.uniform(0, 0.1, (size, size)), blob + rng.uniform(0, 0.1, (size, size))])
+    pred = np.clip(ring * 1.2, 0, 1).astype(np.float32)
+    return (image * 20000).astype(np.uint16), pred
+
+
+def test_check_contours_on_lazy_image(tmp_path):
+    image, pred = make_image()
+    tif_path = str(tmp_path / "a-giantin.tif")
+    tifffile.imwrite(tif_path, image, compression="zlib")
+    lazy_image = open_image(tif_path)
+    assert isinstance(lazy_image, LazyImage)
+    contours, _ = cv2.findContours((pred > 0.5).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    contour = max(contours, key=cv2.contourArea)
+    results = []
+    for golgi_image in (image.transpose((1, 2, 0)), lazy_image.transpose((1, 2, 0))):
+        results.append(check_contours(golgi_image, pred, contour, min_giantin_area=150,
+                                      giantin_possibility_threshold=0.6, giantin_channel=0, rect_size=50))
+    (golgi, _, _, _, flag, sub_list, reject_msg, roi_coord), expected = results[1], results[0]
+    assert flag == expected[4]
+    assert reject_msg == expected[6]
+    assert sub_list == expected[5]
+    assert roi_coord == expected[7]
+    np.testing.assert_array_equal(golgi, expected[0])
+
+
+def test_crop_is_channel_planar(tmp_path):
+    image, _ = make_image(40)
+    tif_path = str(tmp_path / "a-giantin.tif")
+    tifffile.imwrite(tif_path, image, compression="zlib")
+    crop = open_image(tif_path).transpose((1, 2, 0))[5:25, 5:25, :]
+    np.testing.assert_array_equal(crop, image.transpose((1, 2, 0))[5:25, 5:25, :])
+    assert crop[:, :, 0].flags.c_contiguous
@@ -0,0 +1,38 @@
+import os
+
+from local_cache import LocalFileCache
+
+
+def test_hit_keeps_mtime(tmp_path):
+    src = tmp_path / "a-giantin.tif"
+    src.write_bytes(b"tif" * 100)
+    cache = LocalFileCache(str(tmp_path / "cache"), max_size_mb=1)
+    try:
+        cache_path = cache.get(str(src))
+        mtime_ns = os.stat(cache_path).st_mtime_ns
+        os.utime(cache_path, ns=(0, mtime_ns))
+        assert cache.get(str(src)) == cache_path
+        stat = os.stat(cache_path)
+        assert stat.st_mtime_ns == mtime_ns
+        assert stat.st_atime_ns > 0
+    finally:
+        cache.close()
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = LocalFileCache(str(tmp_path / "cache"), max_size_mb=1)
+    try:
+        paths = []
+        for name in ("a.tif", "b.tif", "c.tif"):
+            src = tmp_path / name
+            src.write_bytes(b"0" * 400 * 1024)
+            paths.append(str(src))
+        first_copy = cache.get(paths[0])
+        second_copy = cache.get(paths[1])
+        os.utime(second_copy, ns=(1, os.stat(second_copy).st_mtime_ns))
+        os.utime(first_copy, ns=(2, os.stat(first_copy).st_mtime_ns))
+        cache.get(paths[2])
+        assert os.path.exists(first_copy)
+        assert not os.path.exists(second_copy)
+    finally:
+        cache.close()
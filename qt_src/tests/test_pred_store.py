@@ -0,0 +1,40 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from pred_store import CompactPred
+
+
+@pytest.mark.parametrize("pixel_threshold", [0.0, 0.1, 0.5, 0.73, 0.999, 1.0])
+def test_same_thresholded_mask(pixel_threshold):
+    rng = np.random.default_rng(0)
+    pred = rng.uniform(0, 1, (64, 80)).astype(np.float32)
+    # values next to the threshold
+    pred[0, :3] = np.float32(pixel_threshold)
+    pred[1, :3] = np.nextafter(np.float32(pixel_threshold), np.float32(1))
+    pred[2, :3] = np.nextafter(np.float32(pixel_threshold), np.float32(0))
+    compact = CompactPred(pred, pixel_threshold)
+    restored = compact.to_array()
+    assert restored.dtype == np.float32
+    np.testing.assert_array_equal(restored > pixel_threshold, pred > pixel_threshold)
+    assert compact.nbytes * 4 == pred.nbytes
+
+
+def test_quantization_error():
+    rng = np.random.default_rng(1)
+    pred = rng.uniform(0, 1, (64, 64)).astype(np.float32)
+    restored = CompactPred(pred, 0.5).to_array()
+    # at most one step of the codes above the threshold, 0.5 / 127
+    assert np.abs(restored - pred).max() <= 0.5 / 127 + 1e-6
+
+
+def test_crop_keeps_regions():
+    pred = np.zeros((200, 200), dtype=np.float32)
+    pred[50:60, 50:60] = 0.9
+    pred[150:152, 10:12] = 0.3
+    compact = CompactPred(pred, 0.5, crop=True, margin=8)
+    restored = compact.to_array()
+    np.testing.assert_array_equal(restored > 0.5, pred > 0.5)
+    # outside the crops around thresholded regions
+    assert not restored[150:152, 10:12].any()
@@ -12,12 +12,78 @@ import math
 from matplotlib.patches import Ellipse
 
 
-def purify_mask_withPlot(img, show_plot=True, has_sideview=False):
+def subtraction_levels(img, min_sub=20):
+    """
+    Background levels, relative to img, that repeated bgst with sub = max(min nonzero, min_sub) steps through.
+    :return: ascending list of levels, the last one clears the whole image
+    """
+    values = np.unique(img[img > 0])
+    levels = []
+    if values.size == 0:
+        return levels
+    max_value = values[-1].item()
+    level = 0
+    while level < max_value:
+        idx = np.searchsorted(values, level, side="right")
+        level = min(max(values[idx].item(), level + min_sub), max_value)
+        levels.append(level)
+    return levels
+
+
+def giantin_contours_unsettled(img):
+    """
+    The same decision as purify_mask_withPlot: the only contour is in the edge, or more than one contour is left.
+    """
+    h, w = img.shape
+    mask = img / (img + 1) * 255
+    mask = mask.astype(np.uint8)
+    _, mask = cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    num_contours = len(contours)
+    num_accept = 0
+    for contour in sorted(contours, key=lambda x: cv2.contourArea(x)):
+        if cv2.contourArea(contour) <= 100:
+            num_contours -= 1
+            continue
+        c_x = contour[:, :, 0].reshape(-1, )
+        c_y = contour[:, :, 1].reshape(-1, )
+        if h - 1 in c_x or w - 1 in c_y or 0 in c_x or 0 in c_y:
+            if num_contours == 1:
+                return True
+            num_contours -= 1
+            continue
+        num_accept += 1
+    return num_accept > 1
+
+
+def search_subtraction_level(img, min_sub=20):
+    """
+    Bisect the bgst levels from the histogram of img for the first one with a settled contour, instead of one
+    Otsu thresholding per step. Assumes the contours stay settled at higher levels.
+    :return: sub to apply to img
+    """
+    levels = subtraction_levels(img, min_sub)
+    if not levels:
+        return min_sub
+    lo, hi = -1, len(levels) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        probe = np.where(img > levels[mid], img - levels[mid], 0).astype(img.dtype)
+        if giantin_contours_unsettled(probe):
+            lo = mid
+        else:
+            hi = mid
+    return levels[hi]
+
+
+def purify_mask_withPlot(img, show_plot=True, has_sideview=False, level_search="step"):
     """
 
     :param has_sideview: exist sideview roi
     :param img:  roi of giantin
     :param show_plot: show plots
+    :param level_search: "step": raise the bgst level by the min nonzero value each round. "bisect": bisect the
+        levels from the histogram for the first one with a settled contour.
     :return:
     """
     row, column = 1, 4
@@ -76,7 +142,10 @@ def purify_mask_withPlot(img, show_plot=True, has_sideview=False):
                     continue
             accept_contours.append(contour)
         if do_sub or len(accept_contours) > 1:
-            sub = max(np.where(task_img > 0, task_img, np.inf).min(), 20)
+            if level_search == "bisect":
+                sub = search_subtraction_level(task_img)
+            else:
+                sub = max(np.where(task_img > 0, task_img, np.inf).min(), 20)
             # sub = 40
         else:
             if num_contours == 0:
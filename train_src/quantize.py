@@ -0,0 +1,119 @@
+import argparse
+import random
+
+import numpy as np
+import tensorflow as tf
+from keras.models import load_model
+
+from TFRecord_func import TFRecord_to_data
+from functions import make_model_input, clear_blank_mask
+
+tfrecord_train_path = "../data/train"
+tfrecord_test_path = "../data/test"
+
+
+def load_tfrecord_patches(tfrecord_path):
+    images, masks, _ = TFRecord_to_data(tfrecord_path)
+    X, _ = make_model_input(images, do_norm=True, data_shape=(-1, 256, 256, 1))
+    y, _ = make_model_input(masks, do_norm=False, data_shape=(-1, 256, 256, 1))
+    return X, y
+
+
+def representative_dataset(tfrecord_path, num_samples=200, ratio_of_blank=0.2):
+    """
+    Representative patches for int8 calibration, drawn from the training TFRecords.
+    Blank patches are kept at the same ratio as training.
+    :param tfrecord_path:
+    :param num_samples: no. of calibration patches
+    :param ratio_of_blank: ratio of blank patches, the same as train.py
+    :return: generator function for TFLiteConverter.representative_dataset
+    """
+    X, y = load_tfrecord_patches(tfrecord_path)
+    X, _ = clear_blank_mask(X, y, ratio_of_blank=ratio_of_blank)
+    index = list(range(len(X)))
+    random.shuffle(index)
+    samples = X[index[:num_samples]].astype(np.float32)
+
+    def gen():
+        for sample in samples:
+            yield [sample[np.newaxis]]
+
+    return gen
+
+
+def quantize_model(h5_path, output_path, tfrecord_path=tfrecord_train_path, num_samples=200):
+    """
+    Post-training int8 quantization of a trained U-Net/U-Net++ checkpoint.
+    Input and output stay float32, so the .tflite file is a drop-in for the tflite backend of qt_src.
+    :param h5_path: trained .h5 model
+    :param output_path: output .tflite file
+    :param tfrecord_path: TFRecords of the representative dataset
+    :param num_samples: no. of calibration patches
+    :return: output_path
+    """
+    model = load_model(h5_path, compile=False)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(tfrecord_path, num_samples)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.float32
+    converter.inference_output_type = tf.float32
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+    return output_path
+
+
+def tflite_predict(tflite_path, X, batch_size=8):
+    interpreter = tf.lite.Interpreter(model_path=tflite_path)
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+    interpreter.resize_tensor_input(input_index, (batch_size, 256, 256, 1))
+    interpreter.allocate_tensors()
+    pred = []
+    for i in range(0, len(X), batch_size):
+        batch = np.zeros((batch_size, 256, 256, 1), dtype=np.float32)
+        num = min(batch_size, len(X) - i)
+        batch[:num] = X[i:i + num]
+        interpreter.set_tensor(input_index, batch)
+        interpreter.invoke()
+        pred.append(np.copy(interpreter.get_tensor(output_index))[:num])
+    return np.concatenate(pred, axis=0)
+
+
+def validate_quantized(h5_path, tflite_path, tfrecord_path=tfrecord_test_path, pixel_threshold=0.5, batch_size=8):
+    """
+    Dice/IoU between the float and the quantized masks, after the same pixel threshold as analysis_golgi.
+    :param h5_path: float model
+    :param tflite_path: quantized model
+    :param tfrecord_path: TFRecords of the validation patches
+    :param pixel_threshold: param_pixel_threshold
+    :param batch_size:
+    :return: dict of dice, iou and no. of patches whose masks are different
+    """
+    X, _ = load_tfrecord_patches(tfrecord_path)
+    float_mask = load_model(h5_path, compile=False).predict(X, batch_size=batch_size) > pixel_threshold
+    quant_mask = tflite_predict(tflite_path, X, batch_size=batch_size) > pixel_threshold
+    intersection = np.logical_and(float_mask, quant_mask).sum()
+    total = float_mask.sum() + quant_mask.sum()
+    union = total - intersection
+    changed = np.any(float_mask != quant_mask, axis=(1, 2, 3)).sum()
+    return {"dice": 2 * intersection / total if total > 0 else 1.0,
+            "iou": intersection / union if union > 0 else 1.0,
+            "changed_patches": int(changed),
+            "num_patches": len(X)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Post-training int8 quantization with mask parity validation.")
+    parser.add_argument("model", help="trained .h5 model")
+    parser.add_argument("--output", default="../model/model_int8.tflite")
+    parser.add_argument("--train", default=tfrecord_train_path, help="TFRecords of the representative dataset")
+    parser.add_argument("--test", default=tfrecord_test_path, help="TFRecords of the validation patches")
+    parser.add_argument("--num_samples", type=int, default=200)
+    parser.add_argument("--pixel_threshold", type=float, default=0.5)
+    args = parser.parse_args()
+    quantize_model(args.model, args.output, args.train, args.num_samples)
+    result = validate_quantized(args.model, args.output, args.test, args.pixel_threshold)
+    print("Quantized model saved to {}".format(args.output))
+    print("dice: {:.4f}, iou: {:.4f}, changed patches: {}/{}".format(result["dice"], result["iou"],
+                                                                   result["changed_patches"], result["num_patches"]))